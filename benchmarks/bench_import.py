@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Measures how much the plugin adds to nixops CLI startup by importing it
+# the way nixops loads plugins, in fresh interpreters with -X importtime.
+# Modules of the plugin itself are reported separately from the nixops
+# modules it pulls in, which nixops imports on startup regardless.
+#
+#   python benchmarks/bench_import.py --runs 10
+
+from typing import Dict, List
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+PLUGIN_MODULES = ("nixops_wg_links.plugin", "nixops_wg_links.resources.wg_keypair")
+
+IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def import_times(modules: List[str]) -> Dict[str, int]:
+
+    # Self time in microseconds of every module imported by the interpreter
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "; ".join(f"import {m}" for m in modules),
+        ],
+        check=True,
+        universal_newlines=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    times: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(1))
+    return times
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Benchmark plugin import time")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    plugin_us: List[int] = []
+    total_us: List[int] = []
+    for _ in range(args.runs):
+        times = import_times(list(PLUGIN_MODULES))
+        plugin_us.append(
+            sum(t for m, t in times.items() if m.split(".")[0] == "nixops_wg_links")
+        )
+        total_us.append(sum(times.values()))
+
+    print(
+        json.dumps(
+            {
+                "benchmark": "import",
+                "runs": args.runs,
+                "plugin_ms": round(statistics.median(plugin_us) / 1000, 3),
+                "total_ms": round(statistics.median(total_us) / 1000, 3),
+            },
+            sort_keys=True,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
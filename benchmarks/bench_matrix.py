@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks for physical spec generation (mk_matrix) and wireguard key
+# setup (generate_wg_keypair) over synthetic in-memory deployments.
+#
+# No cloud backend or ssh is used: machines and keypairs are real nixops
+# resource state objects backed by an in-memory sqlite state database, and
+# remote commands are answered by a stub.  Results are printed as JSON
+# lines which can be saved and compared across commits:
+#
+#   python benchmarks/bench_matrix.py --output before.json
+#   python benchmarks/bench_matrix.py --compare before.json
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import argparse
+import json
+import logging
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import nixops.backends
+import nixops_wg_links.instrumentation
+import nixops_wg_links.lib
+from nixops_wg_links.keygen import in_process_backend
+from nixops_wg_links.resources.wg_keypair import WgKeypairState
+
+DEFAULT_SIZES = {
+    "mesh": [10, 50, 100, 300],
+    "star": [10, 100, 500, 1000, 5000],
+    "ring": [10, 100, 500, 1000, 5000],
+}
+
+
+def mesh(names: Sequence[str]) -> Dict[str, List[str]]:
+    return {n: [m for m in names if m != n] for n in names}
+
+
+def star(names: Sequence[str]) -> Dict[str, List[str]]:
+    hub = names[0]
+    return {n: list(names[1:]) if n == hub else [hub] for n in names}
+
+
+def ring(names: Sequence[str]) -> Dict[str, List[str]]:
+    count = len(names)
+    return {
+        n: sorted({names[(i - 1) % count], names[(i + 1) % count]} - {n})
+        for i, n in enumerate(names)
+    }
+
+
+TOPOLOGIES: Dict[str, Callable[[Sequence[str]], Dict[str, List[str]]]] = {
+    "mesh": mesh,
+    "star": star,
+    "ring": ring,
+}
+
+
+class BenchDefinition:
+    """Stand-in for an evaluated machine definition."""
+
+    def __init__(self, name: str, links: List[str]):
+        self.name = name
+        self.resource_eval = {"wgLinksTo": links}
+
+
+class BenchMachineState(nixops.backends.MachineState):
+    """Machine state without a backend; remote commands are recorded."""
+
+    def address_to(self, r):
+        if isinstance(r, nixops.backends.MachineState):
+            return r.public_ipv4
+        return None
+
+    def run_command(self, command, check=True, capture_stdout=False, **kwargs):
+        self.depl.commands.append((self.name, command))
+        return "" if capture_stdout else 0
+
+
+class BenchConnection(sqlite3.Connection):
+    """State database connection serialising transactions between threads."""
+
+    # Like nixops.statefile.Connection: plugin hooks and workers share the
+    # connection, and nested transactions only commit at the outermost one
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+        self.nesting = 0
+
+    def __enter__(self) -> "BenchConnection":
+        self.lock.acquire()
+        self.nesting += 1
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        try:
+            self.nesting -= 1
+            if self.nesting == 0:
+                super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.lock.release()
+
+
+class BenchDeployment:
+    """Deployment stand-in holding resources in an in-memory state database."""
+
+    def __init__(self):
+        self.uuid = "00000000-0000-0000-0000-000000000000"
+        self._db = sqlite3.connect(
+            ":memory:", check_same_thread=False, factory=BenchConnection
+        )
+        self._db.execute(
+            "create table ResourceAttrs (machine integer not null, name text not null, "
+            + "value text not null, primary key(machine, name))"
+        )
+        # Added alongside the plugin instrumentation rather than set on the
+        # connection, where instrumentation would replace it
+        nixops_wg_links.instrumentation.add_trace_callback(self._db, self._trace)
+        self.resources: Dict[str, Any] = {}
+        self.definitions: Dict[str, BenchDefinition] = {}
+        self.commands: List[Any] = []
+        self.reads = 0
+        self.writes = 0
+
+    def _trace(self, statement: str) -> None:
+        verb = statement.lstrip()[:6].lower()
+        if verb == "select":
+            self.reads += 1
+        elif verb in ("insert", "delete", "update"):
+            self.writes += 1
+
+    def reset_counters(self) -> None:
+        self.reads = 0
+        self.writes = 0
+        self.commands = []
+
+    @property
+    def active_resources(self) -> Dict[str, Any]:
+        return self.resources
+
+    @property
+    def active_machines(self) -> Dict[str, Any]:
+        return {
+            n: r
+            for n, r in self.resources.items()
+            if isinstance(r, nixops.backends.MachineState)
+        }
+
+    def _machine_definition_for_required(self, name: str) -> BenchDefinition:
+        return self.definitions[name]
+
+
+def _new_state(cls, depl: BenchDeployment, name: str, id: int):
+    # Skip the nixops constructors, which expect a real deployment
+    r = cls.__new__(cls)
+    r.depl = depl
+    r.name = name
+    r.id = id
+    return r
+
+
+def mk_deployment(topology: str, count: int, keys: bool = True) -> BenchDeployment:
+
+    depl = BenchDeployment()
+    names = [f"machine{i}" for i in range(count)]
+    links = TOPOLOGIES[topology](names)
+
+    with depl._db:
+        for i, name in enumerate(names):
+            m = _new_state(BenchMachineState, depl, name, 2 * i)
+            m.defn = BenchDefinition(name, links[name])
+            m.state = m.UP
+            m.index = i
+            m.public_ipv4 = f"198.18.{i // 256}.{i % 256}"
+            depl.definitions[name] = m.defn
+            depl.resources[name] = m
+
+            kp = _new_state(WgKeypairState, depl, f"{name}-wg", 2 * i + 1)
+            kp.state = kp.UP
+            kp.enable = True
+            kp.listen_port = 51820
+            kp.keepalive = 25
+            kp.interface_name = "nixops-wg0"
+            kp.base_ipv4 = {"a": 10, "b": 0, "c": 0, "d": 1}
+            if keys:
+                kp.private = f"private-{name}"
+                kp.public = f"public-{name}"
+                kp.psk = "psk"
+            depl.resources[kp.name] = kp
+
+    depl.reset_counters()
+    return depl
+
+
+def measure(depl: BenchDeployment, fn: Callable[[], Any]) -> Dict[str, Any]:
+
+    depl.reset_counters()
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": round(seconds, 6),
+        "db_reads": depl.reads,
+        "db_writes": depl.writes,
+        "run_commands": len(depl.commands),
+        "peak_kib": peak // 1024,
+    }
+
+
+def bench_mk_matrix(topology: str, count: int) -> List[Dict[str, Any]]:
+
+    depl = mk_deployment(topology, count)
+    links = sum(len(d.resource_eval["wgLinksTo"]) for d in depl.definitions.values())
+    results = []
+    # A first run over fresh state, then a rerun over unchanged state
+    for run in ("cold", "warm"):
+        result = measure(depl, lambda: nixops_wg_links.lib.mk_matrix(depl))
+        result.update(
+            {
+                "benchmark": f"mk_matrix.{run}",
+                "topology": topology,
+                "nodes": count,
+                "links": links,
+            }
+        )
+        results.append(result)
+    return results
+
+
+def bench_generate_wg_keypair(topology: str, count: int) -> Dict[str, Any]:
+
+    depl = mk_deployment(topology, count, keys=False)
+
+    def run() -> None:
+        for m in depl.active_machines.values():
+            nixops_wg_links.lib.generate_wg_keypair(m)
+
+    result = measure(depl, run)
+    result.update(
+        {
+            "benchmark": "generate_wg_keypair",
+            "topology": topology,
+            "nodes": count,
+            "keygen": "in-process" if in_process_backend() else "wg",
+        }
+    )
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            check=True,
+            universal_newlines=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results: List[Dict[str, Any]], baseline_file: str) -> None:
+
+    def key(r: Dict[str, Any]):
+        return (r["benchmark"], r["topology"], r["nodes"])
+
+    with open(baseline_file) as f:
+        baseline = {key(r): r for r in map(json.loads, f) if "benchmark" in r}
+
+    print(
+        f"{'benchmark':<22} {'topology':<6} {'nodes':>6} "
+        + f"{'seconds':>18} {'db_reads':>20} {'peak_kib':>18}"
+    )
+    for r in results:
+        b = baseline.get(key(r))
+        if not b:
+            continue
+        cols = []
+        for field in ("seconds", "db_reads", "peak_kib"):
+            ratio = r[field] / b[field] if b[field] else float("nan")
+            cols.append(f"{b[field]:>8} -> {r[field]:<8} ({ratio:.2f}x)")
+        print(
+            f"{r['benchmark']:<22} {r['topology']:<6} {r['nodes']:>6} " + " ".join(cols)
+        )
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark mk_matrix and generate_wg_keypair"
+    )
+    parser.add_argument(
+        "--topology", action="append", choices=sorted(TOPOLOGIES), default=[]
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",")],
+        help="comma separated node counts, overriding the per topology defaults",
+    )
+    parser.add_argument("--output", help="also write the JSON lines to this file")
+    parser.add_argument("--compare", help="JSON lines file from an earlier run")
+    args = parser.parse_args()
+
+    # Keep plugin logging from dominating the timings
+    logging.disable(logging.INFO)
+
+    revision = git_revision()
+    results: List[Dict[str, Any]] = []
+    for topology in args.topology or sorted(TOPOLOGIES):
+        for count in args.sizes or DEFAULT_SIZES[topology]:
+            runs = bench_mk_matrix(topology, count)
+            runs.append(bench_generate_wg_keypair(topology, count))
+            for r in runs:
+                r["revision"] = revision
+                print(json.dumps(r, sort_keys=True))
+                sys.stdout.flush()
+            results.extend(runs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for r in results:
+                f.write(json.dumps(r, sort_keys=True) + "\n")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+import threading
 
 # List of module loggers nixops_wg_links utilizes as part of the plugin.
 # These will be set to either INFO or DEBUG level depending on use of the
@@ -8,17 +12,52 @@ import sys
 # from the python root logger) is not included as nixops core should
 # probably handle that instead of plugins which might attempt conflicting
 # actions.
-plugin_log_list = [__name__, "lib", "wg_keypair"]
-
-for logger_name in plugin_log_list:
-    logger = logging.getLogger(logger_name)
-    ch = logging.StreamHandler()
-    logger.addHandler(ch)
-    lh = logging.handlers.SysLogHandler(address="/dev/log")  # type: ignore
-    lf = logging.Formatter("{0}[{1}]: %(message)s".format(logger_name, os.getpid()))
-    lh.setFormatter(lf)
-    logger.addHandler(lh)
-    if "--debug" in sys.argv[1:]:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
+plugin_log_list = [__name__, "lib", "wg_keypair", "wg_topology"]
+
+_logging_lock = threading.Lock()
+_logging_listener = None
+
+
+class _PluginQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler tagging records with the plugin logger they were handled by."""
+
+    def __init__(self, log_queue: queue.Queue, logger_name: str):
+        super().__init__(log_queue)
+        self.logger_name = logger_name
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.plugin_logger = self.logger_name
+        return record
+
+
+def setup_logging() -> None:
+
+    # Handlers are only attached once the plugin is first used, rather than
+    # on import by every nixops invocation that loads plugins.  Syslog writes
+    # are handed off through a queue to a listener thread so they never block
+    # the plugin.
+    global _logging_listener
+    with _logging_lock:
+        if _logging_listener is not None:
+            return
+
+        log_queue: queue.Queue = queue.Queue(-1)
+        lh = logging.handlers.SysLogHandler(address="/dev/log")
+        lf = logging.Formatter(
+            "%(plugin_logger)s[{0}]: %(message)s".format(os.getpid())
+        )
+        lh.setFormatter(lf)
+        _logging_listener = logging.handlers.QueueListener(log_queue, lh)
+        _logging_listener.start()
+        atexit.register(_logging_listener.stop)
+
+        for logger_name in plugin_log_list:
+            logger = logging.getLogger(logger_name)
+            ch = logging.StreamHandler()
+            logger.addHandler(ch)
+            logger.addHandler(_PluginQueueHandler(log_queue, logger_name))
+            if "--debug" in sys.argv[1:]:
+                logger.setLevel(logging.DEBUG)
+            else:
+                logger.setLevel(logging.INFO)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# Timings and counters of the plugin hooks.
+#
+# Instrumentation is off unless one of these environment variables is set:
+#
+#   NIXOPS_WG_LINKS_REPORT   file to append a JSON line report to for each
+#                            instrumented hook invocation
+#   NIXOPS_WG_LINKS_PROFILE  path prefix for cProfile captures of each hook
+#                            invocation, written as <prefix>.<hook>[.<label>].prof
+#
+# A report holds the wall time of the hook and of each phase within it,
+# along with counts of state database attribute reads and writes, remote
+# commands and their latency, and local subprocesses.
+
+from nixops.deployment import Deployment
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = (
+    "db_reads",
+    "db_writes",
+    "run_commands",
+    "run_command_seconds",
+    "subprocesses",
+)
+
+
+class HookReport:
+    """Timings and counters collected over one plugin hook invocation."""
+
+    def __init__(self, hook: str, deployment: str, label: Optional[str] = None):
+        self.hook = hook
+        self.deployment = deployment
+        self.label = label
+        self.seconds = 0.0
+        self.counters: Dict[str, float] = dict.fromkeys(COUNTERS, 0)
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, counter: str, value: float, phase: Optional[str]) -> None:
+        # Counts are kept for the hook and for the phase they occurred in
+        with self._lock:
+            self.counters[counter] += value
+            if phase is not None:
+                self.phases[phase][counter] += value
+
+    def add_phase(self, phase: str) -> None:
+        with self._lock:
+            if phase not in self.phases:
+                self.phases[phase] = dict.fromkeys(("calls", "seconds") + COUNTERS, 0)
+            self.phases[phase]["calls"] += 1
+
+    def add_phase_time(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase]["seconds"] += seconds
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "hook": self.hook,
+            "deployment": self.deployment,
+            "label": self.label,
+            "seconds": round(self.seconds, 6),
+            "counters": {k: round(v, 6) for k, v in self.counters.items()},
+            "phases": {
+                name: {k: round(v, 6) for k, v in phase.items()}
+                for name, phase in self.phases.items()
+            },
+        }
+
+
+# The report and phase the current code runs under, if any.  Worker threads
+# of lib.run_parallel run their tasks in a copy of the submitting context,
+# so their counts are attributed to the hook that started them.
+_current: "contextvars.ContextVar[Optional[Tuple[HookReport, Optional[str]]]]" = (
+    contextvars.ContextVar("nixops_wg_links_report", default=None)
+)
+
+_report_lock = threading.Lock()
+
+# State database connections traced for attribute reads and writes, with the
+# number of hook invocations using each
+_traced: Dict[int, Tuple[Any, int]] = {}
+_traced_lock = threading.Lock()
+
+TraceCallback = Callable[[str], None]
+
+# Trace callbacks of each state database connection, by connection id.
+# sqlite3 does not expose the trace callback in place on a connection, so a
+# single one calling all of these is set instead of each replacing another.
+_trace_callbacks: Dict[int, Tuple[Any, List[TraceCallback]]] = {}
+_trace_callbacks_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(
+        os.environ.get("NIXOPS_WG_LINKS_REPORT")
+        or os.environ.get("NIXOPS_WG_LINKS_PROFILE")
+    )
+
+
+def count(counter: str, value: float = 1) -> None:
+    current = _current.get()
+    if current is not None:
+        current[0].add(counter, value, current[1])
+
+
+def _trace(statement: str) -> None:
+    verb = statement.lstrip()[:6].lower()
+    if verb == "select":
+        count("db_reads")
+    elif verb in ("insert", "update", "delete"):
+        count("db_writes")
+
+
+def _call_trace_callbacks(callbacks: List[TraceCallback], statement: str) -> None:
+    for callback in callbacks:
+        callback(statement)
+
+
+def _set_trace_callbacks(db: Any, callbacks: List[TraceCallback]) -> None:
+    # Lists of callbacks are replaced rather than changed in place, so
+    # statements traced concurrently see either the old or the new one
+    if callbacks:
+        _trace_callbacks[id(db)] = (db, callbacks)
+        db.set_trace_callback(functools.partial(_call_trace_callbacks, callbacks))
+    else:
+        _trace_callbacks.pop(id(db), None)
+        db.set_trace_callback(None)
+
+
+def add_trace_callback(db: Any, callback: TraceCallback) -> None:
+
+    # Call callback with every statement run on a state database connection,
+    # along with any other callback added to it.  Code tracing a connection
+    # the plugin instruments must add its callback here rather than set it
+    # on the connection, where instrumentation would replace it.
+    with _trace_callbacks_lock:
+        (_, callbacks) = _trace_callbacks.get(id(db), (db, []))
+        _set_trace_callbacks(db, callbacks + [callback])
+
+
+def remove_trace_callback(db: Any, callback: TraceCallback) -> None:
+    with _trace_callbacks_lock:
+        (_, callbacks) = _trace_callbacks.get(id(db), (db, []))
+        _set_trace_callbacks(db, [c for c in callbacks if c != callback])
+
+
+def _trace_db(db: Any) -> None:
+    with _traced_lock:
+        (_, users) = _traced.get(id(db), (db, 0))
+        if users == 0:
+            add_trace_callback(db, _trace)
+        _traced[id(db)] = (db, users + 1)
+
+
+def _untrace_db(db: Any) -> None:
+    with _traced_lock:
+        (_, users) = _traced.pop(id(db))
+        if users > 1:
+            _traced[id(db)] = (db, users - 1)
+        else:
+            remove_trace_callback(db, _trace)
+
+
+def _write_report(report: HookReport) -> None:
+    path = os.environ.get("NIXOPS_WG_LINKS_REPORT")
+    if not path:
+        return
+    with _report_lock:
+        with open(path, "a") as f:
+            f.write(json.dumps(report.to_json(), sort_keys=True) + "\n")
+
+
+def _profile_path(hook: str, label: Optional[str]) -> Optional[str]:
+    prefix = os.environ.get("NIXOPS_WG_LINKS_PROFILE")
+    if not prefix:
+        return None
+    return f"{prefix}.{hook}" + (f".{label}" if label else "") + ".prof"
+
+
+@contextlib.contextmanager
+def instrument(
+    hook: str, d: Deployment, label: Optional[str] = None
+) -> Iterator[Optional[HookReport]]:
+
+    # Collect a report over the enclosed hook invocation, when enabled
+    if not enabled():
+        yield None
+        return
+
+    report = HookReport(hook, d.uuid, label)
+    token = _current.set((report, None))
+    _trace_db(d._db)
+
+    profile_path = _profile_path(hook, label)
+    profiling = None
+    if profile_path:
+        # Only imported when profiling, to keep it off the plugin import path
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            profiling = (profiler, profile_path)
+        except ValueError:
+            # Only one profiler can be active at a time on recent pythons,
+            # which concurrent hook invocations may run into
+            logger.debug(f"Skipping profile of {hook} as another one is active")
+
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.seconds = time.perf_counter() - start
+        if profiling is not None:
+            (profiler, profile_path) = profiling
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        _untrace_db(d._db)
+        _current.reset(token)
+        logger.debug(
+            f"{hook}{f' of ‘{label}’' if label else ''} took {report.seconds:.3f}s: "
+            + ", ".join(f"{k} {v:g}" for k, v in report.counters.items())
+        )
+        _write_report(report)
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+
+    # Attribute the time and counts of the enclosed block to a named phase
+    # of the current report; phases do not nest.
+    current = _current.get()
+    if current is None:
+        yield
+        return
+
+    report = current[0]
+    report.add_phase(name)
+    token = _current.set((report, name))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_phase_time(name, time.perf_counter() - start)
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def remote_command() -> Iterator[None]:
+
+    # Count and time the enclosed remote command in the current report
+    if _current.get() is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count("run_commands")
+        count("run_command_seconds", time.perf_counter() - start)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Generation of wireguard keypairs and preshared keys.
+
+from typing import Callable, List, Optional, Tuple
+import base64
+import functools
+import logging
+import nixops.util
+import nixops_wg_links.instrumentation
+import os
+import shlex
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# A (private, public, psk) triple of base64 encoded wireguard keys
+WgKeys = Tuple[str, str, str]
+
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode("ascii")
+
+
+def _clamp(raw: bytes) -> bytes:
+
+    # Clamp the Curve25519 scalar the same way "wg genkey" does
+    key = bytearray(raw)
+    key[0] &= 248
+    key[31] = (key[31] & 127) | 64
+    return bytes(key)
+
+
+def _public_key_cryptography() -> Callable[[bytes], bytes]:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    def public_key(private: bytes) -> bytes:
+        return (
+            X25519PrivateKey.from_private_bytes(private)
+            .public_key()
+            .public_bytes(Encoding.Raw, PublicFormat.Raw)
+        )
+
+    return public_key
+
+
+def _public_key_nacl() -> Callable[[bytes], bytes]:
+    import nacl.public
+
+    def public_key(private: bytes) -> bytes:
+        return bytes(nacl.public.PrivateKey(private).public_key)
+
+    return public_key
+
+
+@functools.lru_cache(maxsize=None)
+def in_process_backend() -> Optional[Callable[[bytes], bytes]]:
+
+    # Curve25519 support is optional; without either library the "wg" tool
+    # is used.  The libraries are only imported once keys are needed, to
+    # keep them off the import path of every nixops invocation.
+    for backend in (_public_key_cryptography, _public_key_nacl):
+        try:
+            return backend()
+        except ImportError:
+            continue
+    return None
+
+
+def get_wg_path() -> str:
+
+    wg_path = nixops.util.which("wg")
+    if not wg_path:
+        raise Exception(
+            'the wireguard tool "wg" must be available in the system path of the deployer for key generation; please install and try again'
+        )
+    return wg_path
+
+
+def _generate_wg_keypairs_wg(
+    count: int, wg_path: str, psk: Optional[str]
+) -> List[WgKeys]:
+
+    # Generate all keys from a single shell rather than one shell per keypair
+    wg = shlex.quote(wg_path)
+    nixops_wg_links.instrumentation.count("subprocesses")
+    try:
+        keypairs = subprocess.run(
+            (f"PSK={shlex.quote(psk)} && " if psk else f'PSK="$({wg} genpsk)" && ')
+            + f"for i in $(seq {count}); do "
+            + f'PRV="$({wg} genkey)" && '
+            + f'PUB="$(printf "%s" "$PRV" | {wg} pubkey)" && '
+            + 'echo "$PRV $PUB $PSK" || exit 1; '
+            + "done",
+            shell=True,
+            check=False,
+            universal_newlines=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except Exception as e:
+        raise Exception(f"wireguard key generation failed with error: ‘{e}’")
+
+    if keypairs.returncode != 0:
+        raise Exception(
+            f"wireguard key generation failed with error: ‘{keypairs.stderr}’"
+        )
+
+    keys: List[WgKeys] = []
+    for line in keypairs.stdout.splitlines():
+        (private, public, psk) = line.split()
+        keys.append((private, public, psk))
+    if len(keys) != count:
+        raise Exception(
+            f"wireguard key generation returned {len(keys)} keypairs, expected {count}"
+        )
+    return keys
+
+
+def generate_wg_keypairs(
+    count: int, wg_path: Optional[str] = None, psk: Optional[str] = None
+) -> List[WgKeys]:
+
+    # All keypairs of a batch share one preshared key, the given one or else
+    # a newly generated one, as every machine of a deployment ends up with
+    # the same preshared key anyway
+    if count <= 0:
+        return []
+
+    public_key = in_process_backend()
+    if public_key is None:
+        logger.debug(
+            f"Generating {count} wireguard keypair(s) with the wg tool; "
+            + "install cryptography or PyNaCl for in-process key generation"
+        )
+        return _generate_wg_keypairs_wg(count, wg_path or get_wg_path(), psk)
+
+    psk = psk or _b64(os.urandom(32))
+    keys: List[WgKeys] = []
+    for _ in range(count):
+        private = _clamp(os.urandom(32))
+        keys.append((_b64(private), _b64(public_key(private)), psk))
+    return keys
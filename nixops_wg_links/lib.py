@@ -3,121 +3,732 @@
 # Automatic provisioning of wireguard links.
 
 from collections import defaultdict, Counter
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
 from nixops.backends import MachineDefinition, MachineState
 from nixops.deployment import Deployment, is_machine
 from typing import (
     Any,
+    Callable,
     cast,
     DefaultDict,
     Dict,
+    FrozenSet,
+    Iterable,
     List,
+    Mapping,
+    NamedTuple,
     Optional,
     Set,
     Tuple,
+    TYPE_CHECKING,
+    TypeVar,
+    Union,
 )
+import base64
+import contextvars
+import functools
+import hashlib
+import hmac
 import ipaddress
+import json
 import logging
 import nixops.resources
 import nixops.util
 import nixops_wg_links.resources
+import os
 import re
 import shlex
-import subprocess
+import threading
+import weakref
+
+from . import remote
+from .instrumentation import phase
+from .keygen import generate_wg_keypairs, get_wg_path, WgKeys  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+DEFAULT_MAX_CONCURRENCY = 16
+
+# Version of the machine spec kept in wgKeypair state, part of its
+# fingerprint so specs stored in an older format are regenerated.
+# 2: peers are kept as the names of the link targets.
+# 3: digests of the peer records and settings outside of the interface are
+#    kept too, for wg-links-plan to compare against.
+SPEC_FORMAT = 3
+
+# Exit status of a conditional key upload finding the keys already in place
+WG_KEYS_IN_SYNC = 3
+
+# Directory of the per link preshared keys on machines, one file per peer
+LINK_PSK_DIR = "/etc/nixops-wg-links/psk.d"
+
+# Deployment state attribute holding the secret per link preshared keys are
+# derived from
+LINK_PSK_SECRET_ATTR = "wgLinks.linkPskSecret"
+
+
+# Settings of a local machine its peer records depend on: the keepalive, the
+# kind of preshared key, the endpoint address selection and the address scope
+# auto endpoints are resolved from, and the relay hub and network
+PeerSettings = Tuple[
+    Optional[int], Optional[str], str, Optional[str], Optional[str], Optional[str]
+]
+
+WgKeypairIndex = Dict[str, nixops_wg_links.resources.wg_keypair.WgKeypairState]
+
+WgKeypairLike = Union[
+    nixops_wg_links.resources.wg_keypair.WgKeypairState,
+    nixops_wg_links.resources.wg_keypair.WgKeypairSnapshot,
+]
+
+# Signature of the resources and definitions of a deployment: the number of
+# resources, the definitions object and the number of definitions.
+DeploymentSignature = Tuple[int, Any, int]
+
+if TYPE_CHECKING:
+    # Per-deployment caches of data derived from the deployment resources and
+    # definitions, each stored along with the signature it was built from.
+    # WeakKeyDictionary is only subscriptable for type checking on python 3.7.
+    DeploymentCache = weakref.WeakKeyDictionary[
+        Deployment, Tuple[DeploymentSignature, Any]
+    ]
+
+_wg_keypair_index: "DeploymentCache" = weakref.WeakKeyDictionary()
+_wg_link_graph: "DeploymentCache" = weakref.WeakKeyDictionary()
+_deployment_cache_lock = threading.Lock()
+
+
+def _deployment_signature(d: Deployment) -> DeploymentSignature:
+
+    # Resources are added to and removed from the deployment in place, and
+    # the active set changes whenever definitions are re-evaluated.  The
+    # definitions object itself is kept rather than its id, which could be
+    # reused by new definitions once the old ones are freed.
+    return (len(d.resources), d.definitions, len(d.definitions or ()))
+
+
+def _same_signature(a: DeploymentSignature, b: DeploymentSignature) -> bool:
+    return a[0] == b[0] and a[1] is b[1] and a[2] == b[2]
+
+
+def _cached_per_deployment(
+    cache: "DeploymentCache",
+    d: Deployment,
+    build: Callable[[Deployment], T],
+    rebuild: bool = False,
+) -> T:
+
+    signature = _deployment_signature(d)
+    with _deployment_cache_lock:
+        cached = cache.get(d)
+        if rebuild or cached is None or not _same_signature(cached[0], signature):
+            cached = (signature, build(d))
+            cache[d] = cached
+    return cached[1]
+
+
+def _mk_wg_keypair_index(d: Deployment) -> WgKeypairIndex:
+    return {
+        r.name: cast(nixops_wg_links.resources.wg_keypair.WgKeypairState, r)
+        for r in d.active_resources.values()
+        if isinstance(r, nixops_wg_links.resources.wg_keypair.WgKeypairState)
+    }
+
+
+def wg_keypair_index(d: Deployment, rebuild: bool = False) -> WgKeypairIndex:
+    return _cached_per_deployment(_wg_keypair_index, d, _mk_wg_keypair_index, rebuild)
+
 
 def findWgKeypair(
     self: MachineState, name: str
 ) -> Optional[nixops_wg_links.resources.wg_keypair.WgKeypairState]:
 
-    for r in self.depl.active_resources.values():
-        if isinstance(r, nixops_wg_links.resources.wg_keypair.WgKeypairState):
-            wg_keypair = cast(nixops_wg_links.resources.wg_keypair.WgKeypairState, r)
-            if wg_keypair.name == name:
-                return wg_keypair
-    return None
+    wg_keypair = wg_keypair_index(self.depl).get(name)
 
+    # Rebuild the index if the resource was replaced since it was built
+    if wg_keypair is not None and self.depl.resources.get(name) is not wg_keypair:
+        wg_keypair = wg_keypair_index(self.depl, rebuild=True).get(name)
+    return wg_keypair
 
-def upload_wg_keypair(
-    self: MachineState, interface_name: str, private: str, public: str, psk: str
-) -> None:
 
-    # Upload the key state
-    res = self.run_command(
-        "umask 077 && mkdir -p /etc/nixops-wg-links && "
+def max_concurrency() -> int:
+
+    # Upper bound on concurrent remote operations issued by the plugin
+    value = os.environ.get("NIXOPS_WG_LINKS_MAX_CONCURRENCY", "")
+    try:
+        return max(1, int(value)) if value else DEFAULT_MAX_CONCURRENCY
+    except ValueError:
+        raise ValueError(
+            f"NIXOPS_WG_LINKS_MAX_CONCURRENCY must be an integer, not ‘{value}’"
+        )
+
+
+def run_parallel(
+    tasks: Mapping[str, Callable[[], T]]
+) -> Tuple[Dict[str, T], Dict[str, Exception]]:
+
+    # Run each named task on a bounded worker pool, collecting results and
+    # failures per name rather than stopping at the first failure.
+    results: Dict[str, T] = {}
+    failures: Dict[str, Exception] = {}
+    if not tasks:
+        return (results, failures)
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency(), len(tasks))) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, task): name
+            for name, task in tasks.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                failures[name] = e
+    return (results, failures)
+
+
+def wg_key_file_digest(key: str) -> str:
+    # Digest of a key file as written by the upload command
+    return hashlib.sha256(f"{key}\n".encode()).hexdigest()
+
+
+def upload_wg_keypair_command(
+    wg_keypair: WgKeypairLike,
+    private: str,
+    public: str,
+    psk: str,
+    only_if_changed: bool = False,
+) -> str:
+
+    # Upload the key state, then make sure the running wireguard interface
+    # will use it, in one round trip: with hot reload the keys are set on the
+    # interface in place, otherwise the wireguard service is stopped to be
+    # started with the new keys upon nixos activation.
+    interface_name = wg_keypair.interface_name
+    iface = shlex.quote(interface_name)
+    command = ""
+    if only_if_changed:
+        # Leave the machine untouched, exiting with WG_KEYS_IN_SYNC, when the
+        # digests of the key files on the machine match the key state
+        digests = " ".join(
+            shlex.quote(f"{wg_key_file_digest(key)}  /etc/nixops-wg-links/{file}")
+            for (file, key) in (
+                ("wireguard.private", private),
+                ("wireguard.public", public),
+                ("wireguard.psk", psk),
+            )
+        )
+        command += (
+            f"if printf '%s\\n' {digests} | sha256sum -c --status 2>/dev/null; then "
+            + f"exit {WG_KEYS_IN_SYNC}; "
+            + "fi; "
+        )
+    command += (
+        "{ umask 077 && mkdir -p /etc/nixops-wg-links && "
         + f'echo "{private}" > /etc/nixops-wg-links/wireguard.private && '
         + f'echo "{public}" > /etc/nixops-wg-links/wireguard.public && '
-        + f'echo "{psk}" > /etc/nixops-wg-links/wireguard.psk',
-        check=False,
+        + f'echo "{psk}" > /etc/nixops-wg-links/wireguard.psk; }} || exit 1; '
+        + f"if systemctl is-active --quiet wg-quick-{interface_name}.service; then "
     )
-    if res != 0:
-        raise Exception(f"unable to save wireguard keys to ‘{self.name}’")
+    if wg_keypair.hot_reload:
+        command += f"wg set {iface} private-key /etc/nixops-wg-links/wireguard.private || exit 2; "
+        # Per link preshared keys are set on the interface by their own upload
+        if wg_keypair.use_psk and not wg_keypair.link_psk:
+            command += (
+                f"for peer in $(wg show {iface} peers); do "
+                + f'wg set {iface} peer "$peer" preshared-key /etc/nixops-wg-links/wireguard.psk || exit 2; '
+                + "done; "
+            )
+    else:
+        command += f"systemctl stop wg-quick-{interface_name}.service || exit 2; "
+    return command + "fi"
 
-    # Stop the wireguard service if running to ensure proper keys will be used upon nixos activation
-    res = self.run_command(
-        f"if systemctl is-active --quiet wg-quick-{interface_name}.service; then "
-        + f"systemctl stop wg-quick-{interface_name}.service || exit 1; "
-        + "else exit 0; "
-        + "fi",
+
+def upload_wg_keypair(
+    self: MachineState,
+    wg_keypair: WgKeypairLike,
+    private: str,
+    public: str,
+    psk: str,
+    only_if_changed: bool = False,
+) -> bool:
+
+    # Returns whether keys were uploaded, which they are not when
+    # only_if_changed is set and the machine already has them
+    res = remote.run_command(
+        self,
+        upload_wg_keypair_command(wg_keypair, private, public, psk, only_if_changed),
         check=False,
     )
-    if res != 0:
+    if res == WG_KEYS_IN_SYNC and only_if_changed:
+        return False
+    if res == 2 and wg_keypair.hot_reload:
         raise Exception(
-            f"unable to stop wg-quick-{interface_name}.service on ‘{self.name}’ after uploading wireguard keys"
+            f"unable to set wireguard keys on interface {wg_keypair.interface_name} of ‘{self.name}’ after uploading them"
         )
+    if res == 2:
+        raise Exception(
+            f"unable to stop wg-quick-{wg_keypair.interface_name}.service on ‘{self.name}’ after uploading wireguard keys"
+        )
+    if res != 0:
+        raise Exception(f"unable to save wireguard keys to ‘{self.name}’")
+    return True
 
 
-def create_wg_keypair(wg_path: str) -> Tuple[str, str, str]:
+def wg_peers_script(
+    interface_name: str, table: Optional[str], peers: List[Dict[str, Any]]
+) -> str:
 
-    try:
-        keypair = subprocess.run(
-            f'PRV="$({shlex.quote(wg_path)} genkey)" && '
-            + f'PUB="$({shlex.quote(wg_path)} pubkey <<< "$PRV")" && '
-            + f'PSK="$({shlex.quote(wg_path)} genpsk)" && '
-            + 'echo "$PRV $PUB $PSK"',
-            shell=True,
-            check=False,
-            universal_newlines=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+    # Shell commands configuring exactly the given peers on a running
+    # wireguard interface, without taking it down: each peer is added or
+    # updated in place along with a route to its addresses, and any other
+    # peer is removed.
+    iface = shlex.quote(interface_name)
+    lines = []
+    for peer in peers:
+        allowed_ips = ",".join(peer["allowedIPs"])
+        lines.append(
+            f"wg set {iface} peer {shlex.quote(peer['publicKey'])} "
+            + f"preshared-key {peer['presharedKeyFile'] or '/dev/null'} "
+            + f"endpoint {shlex.quote(peer['endpoint'])} "
+            + f"persistent-keepalive {peer['persistentKeepalive'] or 'off'} "
+            + f"allowed-ips {shlex.quote(allowed_ips)}"
         )
-    except Exception:
-        raise Exception(
-            f"wireguard key generation failed with error: ‘{keypair.stderr}’"
+        if table != "off":
+            for allowed_ip in peer["allowedIPs"]:
+                lines.append(
+                    f"ip route replace {shlex.quote(allowed_ip)} dev {iface}"
+                    + (f" table {shlex.quote(table)}" if table else "")
+                )
+    wanted = " ".join(peer["publicKey"] for peer in peers)
+    lines.append(
+        f"for peer in $(wg show {iface} peers); do "
+        + f'case " {wanted} " in *" $peer "*) ;; *) wg set {iface} peer "$peer" remove ;; esac; '
+        + "done"
+    )
+    return "\n".join(lines) + "\n"
+
+
+def wg_peers_service(
+    interface_name: str, table: Optional[str], peers: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+
+    # Service configuring the peers of a wg-quick interface separately from
+    # the interface itself.  It is reloaded rather than restarted when its
+    # peers change, so peer changes never restart wg-quick.
+    script = wg_peers_script(interface_name, table, peers)
+    return {
+        "description": f"wg-links peers of wireguard interface {interface_name}",
+        "after": [f"wg-quick-{interface_name}.service"],
+        "partOf": [f"wg-quick-{interface_name}.service"],
+        "wantedBy": [f"wg-quick-{interface_name}.service"],
+        "path": ["/run/current-system/sw"],
+        "serviceConfig": {"Type": "oneshot", "RemainAfterExit": True},
+        "reloadIfChanged": True,
+        "script": script,
+        "reload": script,
+    }
+
+
+def upload_wg_keypairs(
+    uploads: Mapping[str, Tuple[MachineState, WgKeypairLike, str, str, str]]
+) -> Dict[str, Exception]:
+
+    # Upload key state to several machines concurrently, returning the
+    # failures by machine name
+    (_, failures) = run_parallel(
+        {
+            name: functools.partial(upload_wg_keypair, *upload)
+            for name, upload in uploads.items()
+        }
+    )
+    for name, e in failures.items():
+        logger.error(f"wireguard key upload to ‘{name}’ failed: {e}")
+    return failures
+
+
+_link_psk_secret_lock = threading.Lock()
+
+
+def link_psk_secret(d: Deployment) -> bytes:
+
+    # Generated on first use and kept in the deployment state, so the keys
+    # derived from it are stable across deploys.  Like resource attributes,
+    # a missing deployment attribute reads as undefined.
+    with _link_psk_secret_lock:
+        secret = d._get_attr(LINK_PSK_SECRET_ATTR)
+        if secret is nixops.util.undefined or secret is None:
+            logger.debug("Generating the wireguard link preshared key secret")
+            secret = base64.b64encode(os.urandom(32)).decode()
+            d._set_attr(LINK_PSK_SECRET_ATTR, secret)
+    return base64.b64decode(secret)
+
+
+def derive_link_psk(secret: bytes, public: str, peer_public: str) -> str:
+
+    # The public keys are ordered so both ends of a link derive the same key
+    message = "\n".join(sorted((public, peer_public))).encode()
+    return base64.b64encode(hmac.new(secret, message, hashlib.sha256).digest()).decode()
+
+
+def link_psk_file(peer: str) -> str:
+    return f"{LINK_PSK_DIR}/{peer}.psk"
+
+
+def link_psks(
+    secret: bytes, public: str, peers: Mapping[str, str]
+) -> Dict[str, Tuple[str, str]]:
+
+    # Public key and derived preshared key of each peer, given its public key
+    return {
+        peer: (peer_public, derive_link_psk(secret, public, peer_public))
+        for peer, peer_public in peers.items()
+    }
+
+
+def link_psks_digest(psks: Mapping[str, Tuple[str, str]]) -> str:
+    return hashlib.sha256(json.dumps(psks, sort_keys=True).encode()).hexdigest()
+
+
+def upload_link_psks_command(
+    wg_keypair: WgKeypairLike, psks: Mapping[str, Tuple[str, str]]
+) -> str:
+
+    # Replace the per link preshared keys on the machine with the given ones
+    # in one round trip.  wg-quick restarts pick them up from the files,
+    # and with hot reload they are also set on the peers of the running
+    # interface.
+    command = (
+        f"{{ umask 077 && mkdir -p {LINK_PSK_DIR} && cd {LINK_PSK_DIR} && "
+        + "".join(
+            f'echo "{psk}" > {peer}.new && mv {peer}.new {peer}.psk && '
+            for peer, (_, psk) in sorted(psks.items())
         )
+        + "true; } || exit 1; "
+    )
+    keep = " ".join(f"{peer}.psk" for peer in sorted(psks))
+    command += (
+        f"for f in {LINK_PSK_DIR}/*.psk; do "
+        + f'case " {keep} " in *" ${{f##*/}} "*) ;; *) rm -f "$f" ;; esac; '
+        + "done; "
+    )
+    if wg_keypair.hot_reload and psks:
+        interface_name = wg_keypair.interface_name
+        iface = shlex.quote(interface_name)
+        command += (
+            f"if systemctl is-active --quiet wg-quick-{interface_name}.service; then "
+            + f"peers=$(wg show {iface} peers) || exit 2; "
+            + "".join(
+                f'case "$peers" in *{shlex.quote(peer_public)}*) '
+                + f"wg set {iface} peer {shlex.quote(peer_public)} preshared-key {link_psk_file(peer)} || exit 2 ;; esac; "
+                for peer, (peer_public, _) in sorted(psks.items())
+            )
+            + "fi; "
+        )
+    return command + "true"
+
 
-    if keypair.returncode != 0:
+def upload_link_psks(
+    self: MachineState,
+    wg_keypair: WgKeypairLike,
+    psks: Mapping[str, Tuple[str, str]],
+) -> None:
+
+    res = remote.run_command(
+        self, upload_link_psks_command(wg_keypair, psks), check=False
+    )
+    if res == 2:
         raise Exception(
-            f"wireguard key generation failed with error: ‘{keypair.stderr}’"
+            f"unable to set link preshared keys on interface {wg_keypair.interface_name} of ‘{self.name}’ after uploading them"
         )
+    if res != 0:
+        raise Exception(f"unable to save link preshared keys to ‘{self.name}’")
+
+
+def wg_keypair_attr_rows(
+    d: Deployment, ids: Iterable[int], attrs: Iterable[str]
+) -> List[Tuple[int, str, str]]:
+
+    # Rows of the given attributes of the given keypairs, in a single query
+    # restricted to those keypairs rather than every resource of the state
+    # file.  The ids are resource ids from the state file, so they are put in
+    # the query directly rather than running into the limit on the number of
+    # query parameters.
+    ids = sorted(int(id) for id in ids)
+    attrs = list(attrs)
+    if not ids or not attrs:
+        return []
+    with d._db:
+        c = d._db.cursor()
+        c.execute(
+            "select machine, name, value from ResourceAttrs "
+            + f"where machine in ({', '.join(str(id) for id in ids)}) "
+            + f"and name in ({', '.join('?' for _ in attrs)})",
+            attrs,
+        )
+        return c.fetchall()
 
-    keypair_list = keypair.stdout.split()
-    private = keypair_list[0]
-    public = keypair_list[1]
-    psk = keypair_list[2]
-    return (private, public, psk)
 
+def wg_public_keys(d: Deployment, names: Iterable[str]) -> Dict[str, str]:
 
-def get_wg_path() -> str:
+    # Public keys of the keypairs of the given machines, by machine name,
+    # from a single query rather than an attribute read per keypair
+    wg_keypairs = wg_keypair_index(d)
+    ids = {
+        wg_keypairs[f"{name}-wg"].id: name
+        for name in names
+        if f"{name}-wg" in wg_keypairs
+    }
+    rows = wg_keypair_attr_rows(d, ids, ("wgKeypair.public",))
+    return {ids[id]: public for (id, _, public) in rows}
 
-    wg_path = nixops.util.which("wg")
-    if not wg_path:
-        raise Exception(
-            'the wireguard tool "wg" must be available in the system path of the deployer for key generation; please install and try again'
+
+def sync_link_psks(
+    self: MachineState,
+    wg_keypair: nixops_wg_links.resources.wg_keypair.WgKeypairState,
+    force: bool = False,
+) -> None:
+
+    # Upload the preshared keys of the links of the machine to the peers
+    # with keys, unless they are unchanged since the last upload
+    links = wg_link_graph(self.depl).links_of(self.name)
+    peers = wg_public_keys(self.depl, (name for name in links if name != self.name))
+    psks = link_psks(link_psk_secret(self.depl), wg_keypair.public, peers)
+    digest = link_psks_digest(psks)
+    if not force and digest == wg_keypair.link_psk_digest:
+        return
+    logger.debug(f"Uploading {len(psks)} link preshared key(s) to ‘{self.name}’")
+    upload_link_psks(self, wg_keypair, psks)
+    save_wg_keypair_attrs(wg_keypair, {"link_psk_digest": digest})
+
+
+def create_wg_keypair(
+    wg_path: Optional[str] = None, psk: Optional[str] = None
+) -> WgKeys:
+    return generate_wg_keypairs(1, wg_path, psk)[0]
+
+
+def wg_consensus_psk(d: Deployment) -> Optional[str]:
+
+    # The preshared key most keypairs of the deployment have, which new
+    # keypairs are given so the psk consensus of mk_matrix has no machine to
+    # re-upload it to.  Keypairs with per link preshared keys are left out,
+    # as they are in the consensus.  Read from a single query rather than an
+    # attribute read per keypair.
+    ids = {wg_keypair.id for wg_keypair in wg_keypair_index(d).values()}
+    psks: Dict[int, str] = {}
+    link_psk: Set[int] = set()
+    rows = wg_keypair_attr_rows(
+        d, ids, ("wgKeypair.presharedKey", "wgKeypair.linkPresharedKeys")
+    )
+    for (id, name, value) in rows:
+        if name == "wgKeypair.presharedKey":
+            psks[id] = value
+        elif value == "1":
+            link_psk.add(id)
+    counts = Counter(psk for id, psk in psks.items() if id not in link_psk)
+    return counts.most_common(1)[0][0] if counts else None
+
+
+# Keys generated ahead of time for keypairs that still need them, by keypair name
+_pregenerated_wg_keys: "weakref.WeakKeyDictionary[Deployment, Dict[str, WgKeys]]" = weakref.WeakKeyDictionary()
+_pregenerated_wg_keys_lock = threading.Lock()
+
+
+def pregenerate_wg_keypairs(d: Deployment) -> int:
+
+    # Generate keys in a single pass for every keypair of a linked machine
+    # which has no key state yet, so each keypair only has to claim them.
+    with _pregenerated_wg_keys_lock:
+        pending = _pregenerated_wg_keys.setdefault(d, {})
+        wg_keypairs = wg_keypair_index(d)
+        graph = wg_link_graph(d)
+        names = []
+        for name in wg_keypairs:
+            if name in pending or not graph.links_of(re.sub("-wg$", "", name)):
+                continue
+            wg_keypair = wg_keypairs[name].snapshot()
+            if not wg_keypair.private or not wg_keypair.public or not wg_keypair.psk:
+                names.append(name)
+
+        if names:
+            logger.debug(f"Pregenerating {len(names)} wireguard keypair(s)")
+            pending.update(
+                zip(names, generate_wg_keypairs(len(names), psk=wg_consensus_psk(d)))
+            )
+        return len(names)
+
+
+# Outcome of the syncState key checks of each machine, True when keys were
+# re-uploaded and False when they were found in sync, by deployment
+_wg_keys_synced: "weakref.WeakKeyDictionary[Deployment, Dict[str, bool]]" = weakref.WeakKeyDictionary()
+_wg_keys_synced_lock = threading.Lock()
+
+
+def record_wg_keys_synced(d: Deployment, name: str, uploaded: bool) -> None:
+    with _wg_keys_synced_lock:
+        _wg_keys_synced.setdefault(d, {})[name] = uploaded
+
+
+def report_wg_keys_synced(d: Deployment) -> None:
+
+    # Summarize the syncState key checks made since the last report
+    with _wg_keys_synced_lock:
+        synced = _wg_keys_synced.pop(d, {})
+    if synced:
+        skipped = sum(1 for uploaded in synced.values() if not uploaded)
+        logger.info(
+            f"Wireguard key state was already in sync on {skipped} of {len(synced)} "
+            + "machine(s) with syncState, skipped re-uploading keys to them"
         )
-    return wg_path
+
+
+# Machines whose post_wait hook ran, which are the machines included in the
+# deploy in progress, by deployment
+_wg_deploying: "weakref.WeakKeyDictionary[Deployment, Set[str]]" = weakref.WeakKeyDictionary()
+_wg_deploying_lock = threading.Lock()
+
+
+def record_wg_deploying(d: Deployment, name: str) -> None:
+    with _wg_deploying_lock:
+        _wg_deploying.setdefault(d, set()).add(name)
+
+
+def wg_deploying(d: Deployment) -> FrozenSet[str]:
+
+    # Empty when no post_wait hook ran, such as for a dry run, a build or
+    # copy only deploy, or when the physical spec is generated outside of a
+    # deploy, in which case no machine is taken to be deployed
+    with _wg_deploying_lock:
+        return frozenset(_wg_deploying.get(d, ()))
+
+
+def take_wg_keypair(d: Deployment, name: str) -> WgKeys:
+
+    with _pregenerated_wg_keys_lock:
+        keys = _pregenerated_wg_keys.get(d, {}).pop(name, None)
+    if keys is None:
+        pregenerate_wg_keypairs(d)
+        with _pregenerated_wg_keys_lock:
+            keys = _pregenerated_wg_keys.get(d, {}).pop(name, None)
+    return keys if keys is not None else create_wg_keypair(psk=wg_consensus_psk(d))
+
+
+# A queued write: the resource, its attributes, the context of the hook which
+# submitted it and the future completed once it is committed
+StateWrite = Tuple[Any, Dict[str, Any], contextvars.Context, Future]
+
+
+class WgStateWriter:
+    """Serialized writer of wireguard keypair state for concurrent machine hooks."""
+
+    def __init__(self, d: Deployment):
+        # Writes queued while a transaction is in progress are committed
+        # together in the next one, by a single writer thread, rather than
+        # each hook thread taking the state file lock for a transaction of
+        # its own
+        self._db = d._db
+        self._lock = threading.Lock()
+        self._pending: List[StateWrite] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, resource: Any, attrs: Dict[str, Any]) -> Future:
+        # Writes are made in a copy of the context of the submitting hook, so
+        # they are counted in its instrumentation report
+        future: Future = Future()
+        with self._lock:
+            self._pending.append((resource, attrs, contextvars.copy_context(), future))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="nixops-wg-links-state-writer", daemon=True
+                )
+                self._thread.start()
+        return future
+
+    def _run(self) -> None:
+        # The thread exits once the queue is drained, and is started again
+        # by the next submission
+        while True:
+            with self._lock:
+                (batch, self._pending) = (self._pending, [])
+                if not batch:
+                    self._thread = None
+                    return
+            try:
+                with self._db:
+                    for resource, attrs, context, _ in batch:
+                        context.run(self._write, resource, attrs)
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, _, _, future in batch:
+                    future.set_result(None)
+
+    @staticmethod
+    def _write(resource: Any, attrs: Dict[str, Any]) -> None:
+        for attr, value in attrs.items():
+            setattr(resource, attr, value)
+
+
+_wg_state_writers: "weakref.WeakKeyDictionary[Deployment, WgStateWriter]" = weakref.WeakKeyDictionary()
+_wg_state_writers_lock = threading.Lock()
+
+
+def save_wg_keypair_attrs(
+    wg_keypair: nixops_wg_links.resources.wg_keypair.WgKeypairState,
+    attrs: Dict[str, Any],
+) -> None:
+
+    # Write the attributes of a keypair in a single transaction, shared with
+    # the writes of other hooks queued at the same time, and wait for it to
+    # be committed.  Must not be called within a state transaction, which
+    # would hold the lock the writer needs.
+    with _wg_state_writers_lock:
+        if wg_keypair.depl not in _wg_state_writers:
+            _wg_state_writers[wg_keypair.depl] = WgStateWriter(wg_keypair.depl)
+        writer = _wg_state_writers[wg_keypair.depl]
+    writer.submit(wg_keypair, attrs).result()
+
+
+def create_wg_keypair_state(
+    wg_keypair: nixops_wg_links.resources.wg_keypair.WgKeypairState,
+) -> None:
+
+    # Generate the keys of a keypair of a linked machine as it is created,
+    # while machines are still being created too, leaving only their upload
+    # to the post_wait hook
+    if wg_keypair.private and wg_keypair.public and wg_keypair.psk:
+        return
+    if not wg_link_graph(wg_keypair.depl).links_of(re.sub("-wg$", "", wg_keypair.name)):
+        return
+
+    logger.debug(f"Creating wireguard keypair state for ‘{wg_keypair.name}’")
+    (private, public, psk) = take_wg_keypair(wg_keypair.depl, wg_keypair.name)
+    save_wg_keypair_attrs(
+        wg_keypair,
+        {
+            "private": private.strip(),
+            "public": public.strip(),
+            "psk": psk.strip(),
+            "pending_upload": True,
+        },
+    )
 
 
 def generate_wg_keypair(self: MachineState) -> None:
 
-    defn = to_wg_links_defn(self.defn)
+    # The configuration generated for the machine is recorded as deployed
+    # in state only when it is included in the deploy
+    record_wg_deploying(self.depl, self.name)
 
     # Only generate keys for which there is a wgLinksTo nix definition
-    if len(defn.wgLinksTo) == 0:
+    if not self.defn or not wg_link_graph(self.depl).links_of(self.name):
         return
 
-    wg_path = get_wg_path()
     wg_keypair = findWgKeypair(self, f"{self.name}-wg")
     if not wg_keypair:
         raise Exception(f"wireguard link resource not found for ‘{self.name}’")
@@ -126,26 +737,46 @@ def generate_wg_keypair(self: MachineState) -> None:
         # If the wireguard keypair does not yet exist yet,
         # create, upload and save in nixops state
         logger.debug(f"Creating wireguard keypair state for ‘{self.name}’")
-        (private, public, psk) = create_wg_keypair(wg_path)
+        (private, public, psk) = take_wg_keypair(self.depl, wg_keypair.name)
         upload_wg_keypair(
             self,
-            wg_keypair.interface_name,
+            wg_keypair,
             private.strip(),
             public.strip(),
             psk.strip(),
         )
-        wg_keypair.private = private.strip()
-        wg_keypair.public = public.strip()
-        wg_keypair.psk = psk.strip()
-    elif wg_keypair.sync_state:
-        # If a sync_state has been requested, repush
+        save_wg_keypair_attrs(
+            wg_keypair,
+            {"private": private.strip(), "public": public.strip(), "psk": psk.strip()},
+        )
+    elif wg_keypair.pending_upload:
+        # Keys generated when the keypair was created still need uploading
+        logger.debug(f"Uploading wireguard keypair state to ‘{self.name}’")
         upload_wg_keypair(
             self,
-            wg_keypair.interface_name,
+            wg_keypair,
             wg_keypair.private,
             wg_keypair.public,
             wg_keypair.psk,
         )
+        save_wg_keypair_attrs(wg_keypair, {"pending_upload": False})
+    elif wg_keypair.sync_state:
+        # If a sync_state has been requested, repush unless the machine
+        # already has the keys in nixops state
+        uploaded = upload_wg_keypair(
+            self,
+            wg_keypair,
+            wg_keypair.private,
+            wg_keypair.public,
+            wg_keypair.psk,
+            only_if_changed=True,
+        )
+        if not uploaded:
+            logger.debug(f"Wireguard key state of ‘{self.name}’ is already in sync")
+        record_wg_keys_synced(self.depl, self.name, uploaded)
+
+    if wg_keypair.use_psk and wg_keypair.link_psk:
+        sync_link_psks(self, wg_keypair, force=wg_keypair.sync_state)
 
 
 class WgLinksDefinition(MachineDefinition):
@@ -171,26 +802,15 @@ class WgLinksState(MachineState[WgLinksDefinition]):
         return "wg-links"
 
 
-def index_to_private_ip(
-    wg_keypair: nixops_wg_links.resources.wg_keypair.WgKeypairState,
-    index: Optional[int],
-) -> str:
-
-    if index is None:
-        raise ValueError(
-            f"‘{re.sub('-wg$', '', wg_keypair.name)}’ is missing an optional machine index that is required for wg-links"
-        )
-
-    a_base = wg_keypair.base_ipv4["a"]
-    b_base = wg_keypair.base_ipv4["b"]
-    c_base = wg_keypair.base_ipv4["c"]
-    d_base = wg_keypair.base_ipv4["d"]
+def base_ipv4_to_int(wg_keypair: WgKeypairLike) -> int:
 
+    base_ipv4 = wg_keypair.base_ipv4
+    base = f"{base_ipv4['a']}.{base_ipv4['b']}.{base_ipv4['c']}.{base_ipv4['d']}"
     try:
-        base_addr = ipaddress.IPv4Address(f"{a_base}.{b_base}.{c_base}.{d_base}")
+        base_addr = ipaddress.IPv4Address(base)
     except ValueError:
         raise ValueError(
-            f"base ipv4 wireguard address {base_addr} for ‘{wg_keypair.name}’ is invalid"
+            f"base ipv4 wireguard address {base} for ‘{wg_keypair.name}’ is invalid"
         )
 
     if not base_addr.is_private:
@@ -198,43 +818,600 @@ def index_to_private_ip(
             f"base ipv4 wireguard address {base_addr} for ‘{wg_keypair.name}’ is not a private ipv4 address"
         )
 
-    d = (d_base + index) % 256
-    d_r = (d_base + index) // 256
-    c = (c_base + d_r) % 256
-    c_r = (c_base + d_r) // 256
-    b = (b_base + c_r) % 256
-    b_r = (b_base + c_r) // 256
-    a = (a_base + b_r) % 256
+    return int(base_addr)
+
+
+def index_to_ipv4_int(wg_keypair: WgKeypairLike, base: int, index: int) -> int:
+
+    # Adding the index to the base address as a 32 bit integer carries
+    # across octets and wraps the same way as octet-wise addition
+    addr = ipaddress.IPv4Address((base + index) % 2 ** 32)
+
+    if not addr.is_private:
+        raise ValueError(
+            f"generated wireguard address {addr} for ‘{wg_keypair.name}’ is not a private ipv4"
+        )
+
+    return int(addr)
+
+
+def ipv4_cidr_to_network(wg_keypair: WgKeypairLike) -> ipaddress.IPv4Network:
 
     try:
-        addr = ipaddress.IPv4Address(f"{a}.{b}.{c}.{d}")
+        network = ipaddress.IPv4Network(wg_keypair.ipv4_cidr)
     except ValueError:
         raise ValueError(
-            f"generated wireguard address {addr} for ‘{wg_keypair.name}’ is invalid"
+            f"ipv4 wireguard cidr {wg_keypair.ipv4_cidr} for ‘{wg_keypair.name}’ is invalid"
         )
 
-    if not addr.is_private:
+    if not network.is_private:
         raise ValueError(
-            f"generated wireguard address {addr} for ‘{wg_keypair.name}’ is not a private ipv4"
+            f"ipv4 wireguard cidr {network} for ‘{wg_keypair.name}’ is not a private ipv4 network"
+        )
+    if network.prefixlen > 30:
+        raise ValueError(
+            f"ipv4 wireguard cidr {network} for ‘{wg_keypair.name}’ is too small, at most a /30 is required"
+        )
+
+    return network
+
+
+class WgAddressTable:
+    """Wireguard IPv4 addresses of all machines in a deployment."""
+
+    def __init__(
+        self,
+        wg_keypairs: Mapping[str, nixops_wg_links.resources.wg_keypair.WgKeypairSnapshot],
+        machines: Mapping[str, MachineState],
+    ):
+        self._addrs: Dict[str, str] = {}
+        self._prefixlen: Dict[str, int] = {}
+        self._missing_index: Dict[str, str] = {}
+
+        # Compute every address from its base and index in a single pass,
+        # validating each distinct base address only once.  Keypairs with an
+        # ipv4Cidr are allocated addresses afterwards, around these.
+        bases: Dict[Tuple[Tuple[str, int], ...], int] = {}
+        networks: Dict[str, ipaddress.IPv4Network] = {}
+        allocated: List[Tuple[str, ipaddress.IPv4Network]] = []
+        by_addr: DefaultDict[int, List[str]] = defaultdict(list)
+        reserved: Set[int] = set()
+        for name, wg_keypair in wg_keypairs.items():
+            if not wg_keypair.is_up:
+                # Addresses kept in state by keypairs which are not up stay
+                # reserved for them, so they get them back once up again
+                if wg_keypair.ipv4_cidr:
+                    kept = self._stored_addr(wg_keypair)
+                    if kept is not None:
+                        reserved.add(kept)
+                continue
+            if wg_keypair.ipv4_cidr:
+                if wg_keypair.ipv4_cidr not in networks:
+                    networks[wg_keypair.ipv4_cidr] = ipv4_cidr_to_network(wg_keypair)
+                allocated.append((name, networks[wg_keypair.ipv4_cidr]))
+                continue
+            index = machines[name].index
+            if index is None:
+                self._missing_index[name] = wg_keypair.name
+                continue
+            base_key = tuple(sorted(wg_keypair.base_ipv4.items()))
+            if base_key not in bases:
+                bases[base_key] = base_ipv4_to_int(wg_keypair)
+            addr = index_to_ipv4_int(wg_keypair, bases[base_key], index)
+            by_addr[addr].append(name)
+            self._addrs[name] = ipaddress.IPv4Address(addr).exploded
+            self._prefixlen[name] = 24
+
+        # Addresses kept in state remain assigned while they are a host
+        # address of their network not taken by another keypair, regardless
+        # of machine indexes.  Any other keypair gets the lowest free address
+        # of its network, found from a cursor only moving forward.
+        pending: List[Tuple[str, ipaddress.IPv4Network]] = []
+        for name, network in allocated:
+            kept = self._stored_addr(wg_keypairs[name])
+            if (
+                kept is not None
+                and int(network.network_address) < kept < int(network.broadcast_address)
+                and kept not in by_addr
+            ):
+                self._assign(name, kept, network, by_addr)
+            else:
+                pending.append((name, network))
+
+        cursors: Dict[ipaddress.IPv4Network, int] = {}
+        for name, network in pending:
+            cursor = cursors.get(network, int(network.network_address) + 1)
+            while cursor in by_addr or cursor in reserved:
+                cursor += 1
+            if cursor >= int(network.broadcast_address):
+                raise ValueError(
+                    f"ipv4 wireguard cidr {network} for ‘{name}’ has no free address left"
+                )
+            self._assign(name, cursor, network, by_addr)
+            cursors[network] = cursor + 1
+
+        self.collisions: List[List[str]] = [
+            names for names in by_addr.values() if len(names) > 1
+        ]
+
+    def _assign(
+        self,
+        name: str,
+        addr: int,
+        network: ipaddress.IPv4Network,
+        by_addr: DefaultDict[int, List[str]],
+    ) -> None:
+        by_addr[addr].append(name)
+        self._addrs[name] = ipaddress.IPv4Address(addr).exploded
+        self._prefixlen[name] = network.prefixlen
+
+    @staticmethod
+    def _stored_addr(
+        wg_keypair: nixops_wg_links.resources.wg_keypair.WgKeypairSnapshot,
+    ) -> Optional[int]:
+        try:
+            return int(ipaddress.IPv4Address(wg_keypair.addr))
+        except ValueError:
+            return None
+
+    def has_index(self, name: str) -> bool:
+        return name not in self._missing_index
+
+    def prefixlen(self, name: str) -> int:
+        # Prefix length of the wireguard interface address
+        return self._prefixlen[name]
+
+    def network(self, name: str) -> ipaddress.IPv4Network:
+        # Network of the wireguard interface address
+        return ipaddress.IPv4Interface(f"{self[name]}/{self._prefixlen[name]}").network
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._addrs
+
+    def __getitem__(self, name: str) -> str:
+        if name in self._missing_index:
+            raise ValueError(
+                f"‘{name}’ is missing an optional machine index that is required for wg-links"
+            )
+        return self._addrs[name]
+
+
+AddressScope = Optional[str]
+
+
+def address_scope(m: MachineState) -> AddressScope:
+
+    # Machines keeping the default address_to reach every resource at the
+    # same address, so they share a scope.  Backends overriding it may choose
+    # the address by anything about the machine and its target, such as its
+    # network or placement, so each of their machines is its own scope.
+    if type(m).address_to is MachineState.address_to:
+        return None
+    return m.name
+
+
+class NowgAddressTable:
+    """Addresses of all active resources as seen from each address scope."""
+
+    def __init__(
+        self,
+        machines: Iterable[MachineState],
+        resources: Mapping[str, nixops.resources.ResourceState],
+    ):
+        self._scopes: Dict[str, AddressScope] = {}
+        self._addresses: Dict[AddressScope, List[Tuple[str, Optional[str]]]] = {}
+        self._address: Dict[AddressScope, Dict[str, Optional[str]]] = {}
+        self._hosts: Dict[AddressScope, Dict[str, List[str]]] = {}
+        self._digests: Dict[AddressScope, str] = {}
+
+        # Resolve the addresses once for all machines of the default scope
+        # and once for each machine of a backend overriding address_to,
+        # concurrently when there are several scopes
+        representatives: Dict[str, MachineState] = {}
+        by_scope: Dict[AddressScope, str] = {}
+        for m in machines:
+            scope = address_scope(m)
+            self._scopes[m.name] = scope
+            if scope not in by_scope:
+                by_scope[scope] = m.name
+                representatives[m.name] = m
+
+        def resolve(m: MachineState) -> List[Tuple[str, Optional[str]]]:
+            return [(r.name, m.address_to(r)) for r in resources.values()]
+
+        if len(representatives) > 1:
+            (results, failures) = run_parallel(
+                {
+                    name: functools.partial(resolve, m)
+                    for name, m in representatives.items()
+                }
+            )
+            if failures:
+                raise Exception(
+                    "unable to resolve resource addresses from "
+                    + ", ".join(f"‘{name}’: {e}" for name, e in failures.items())
+                )
+        else:
+            results = {name: resolve(m) for name, m in representatives.items()}
+
+        for scope, name in by_scope.items():
+            self._addresses[scope] = results[name]
+            self._address[scope] = dict(results[name])
+            hosts: Dict[str, List[str]] = {}
+            for r_name, ip in results[name]:
+                if ip:
+                    hosts[ip] = hosts.get(ip, []) + [r_name + "-nowg"]
+            self._hosts[scope] = hosts
+
+    def scope(self, name: str) -> AddressScope:
+        return self._scopes[name]
+
+    def addresses(self, name: str) -> List[Tuple[str, Optional[str]]]:
+        return self._addresses[self._scopes[name]]
+
+    def digest(self, name: str) -> str:
+        # Digest of the addresses, hashed once per scope
+        scope = self._scopes[name]
+        if scope not in self._digests:
+            self._digests[scope] = hashlib.sha256(
+                json.dumps(self._addresses[scope]).encode()
+            ).hexdigest()[:16]
+        return self._digests[scope]
+
+    def address(self, name: str, target: str) -> Optional[str]:
+        return self._address[self._scopes[name]].get(target)
+
+    def hosts(self, name: str) -> Dict[str, List[str]]:
+        # Shared between all machines of a scope, copy before modifying
+        return self._hosts[self._scopes[name]]
+
+
+WG_TOPOLOGIES = ("mesh", "star", "ring", "knearest")
+
+
+class WgTopology:
+    """Wireguard links of a wgTopology resource, reciprocal by construction."""
+
+    def __init__(
+        self,
+        name: str,
+        topology: str,
+        machines: Iterable[str],
+        hub: Optional[str] = None,
+        k: int = 1,
+        relay: bool = False,
+    ):
+        self.name = name
+        self.topology = topology
+        self.machines: Tuple[str, ...] = tuple(dict.fromkeys(machines))
+        self.hub = hub
+        self.relay = relay
+        self._position = {m: i for i, m in enumerate(self.machines)}
+
+        # Problems of the definition, reported along with the other problems
+        # of the deployment by validate_wg_links.  A topology with problems
+        # contributes no links to the link graph.
+        self.problems: List[str] = []
+        if topology not in WG_TOPOLOGIES:
+            self.problems.append(
+                f"wireguard topology ‘{name}’ has an unknown topology ‘{topology}’"
+            )
+        if topology == "star" and hub not in self._position:
+            self.problems.append(
+                f"wireguard star topology ‘{name}’ requires a hub from its machines, not ‘{hub}’"
+            )
+        if relay and topology != "star":
+            self.problems.append(
+                f"wireguard topology ‘{name}’ can only relay through the hub of a star topology"
+            )
+        if topology == "knearest" and k < 1:
+            self.problems.append(
+                f"wireguard topology ‘{name}’ requires a k of at least 1"
+            )
+
+        # Number of machines linked on each side, for ring-like topologies
+        self._reach = k if topology == "knearest" else 1
+
+    def neighbours(self, name: str) -> Tuple[str, ...]:
+
+        # Links are expanded from the position of a machine in the list,
+        # without building the edges of the whole topology
+        i = self._position.get(name)
+        if i is None:
+            return ()
+        if self.topology == "mesh":
+            return tuple(m for m in self.machines if m != name)
+        if self.topology == "star":
+            if name == self.hub:
+                return tuple(m for m in self.machines if m != self.hub)
+            return (cast(str, self.hub),)
+
+        count = len(self.machines)
+        return tuple(
+            dict.fromkeys(
+                self.machines[(i + offset) % count]
+                for distance in range(1, self._reach + 1)
+                for offset in (-distance, distance)
+                if (i + offset) % count != i
+            )
+        )
+
+    def has_edge(self, a: str, b: str) -> bool:
+        if a == b or a not in self._position or b not in self._position:
+            return False
+        if self.topology == "mesh":
+            return True
+        if self.topology == "star":
+            return self.hub in (a, b)
+        distance = abs(self._position[a] - self._position[b])
+        return min(distance, len(self.machines) - distance) <= self._reach
+
+
+class WgLinkGraph:
+    """Declared wireguard links between the machines of a deployment."""
+
+    def __init__(
+        self,
+        links: Mapping[str, Iterable[str]],
+        topologies: Iterable[WgTopology] = (),
+    ):
+        # Targets keep their declared order, which is the order of the peers
+        self._links: Dict[str, Tuple[str, ...]] = {
+            name: tuple(dict.fromkeys(targets)) for name, targets in links.items()
+        }
+        self.topologies = tuple(topologies)
+        self.problems: List[str] = [
+            problem for topology in self.topologies for problem in topology.problems
+        ]
+        # Only topologies without problems contribute links
+        self._topologies = tuple(t for t in self.topologies if not t.problems)
+        self._merged: Dict[str, Tuple[str, ...]] = {}
+
+        # Hub of each spoke of a relaying star, from the first such topology
+        # listing the spoke, and the hubs relaying traffic between spokes
+        self._relay_hubs: Dict[str, str] = {}
+        for topology in self._topologies:
+            if topology.relay and topology.hub is not None:
+                for spoke in topology.machines:
+                    if spoke != topology.hub:
+                        self._relay_hubs.setdefault(spoke, topology.hub)
+        self.relays: FrozenSet[str] = frozenset(self._relay_hubs.values())
+        self._spokes: Dict[str, List[str]] = {}
+        for spoke, hub in self._relay_hubs.items():
+            self._spokes.setdefault(hub, []).append(spoke)
+
+        # Links declared on only one side are the declared edges missing
+        # from the symmetric difference of the graph and its reverse.
+        # Topology links go both ways, so only wgLinksTo links are checked,
+        # against the topologies for their reverse.
+        edges = {(a, b) for a, targets in self._links.items() for b in targets}
+        reverse = {(b, a) for (a, b) in edges}
+        self.non_reciprocal: FrozenSet[Tuple[str, str]] = frozenset(
+            (a, b)
+            for (a, b) in (edges ^ reverse) & edges
+            if not any(t.has_edge(b, a) for t in self._topologies)
+        )
+
+    def links_of(self, name: str) -> Tuple[str, ...]:
+        if not self._topologies:
+            return self._links.get(name, ())
+
+        # wgLinksTo targets first, followed by those of each topology
+        if name not in self._merged:
+            targets = list(self._links.get(name, ()))
+            for topology in self._topologies:
+                targets.extend(topology.neighbours(name))
+            self._merged[name] = tuple(dict.fromkeys(targets))
+        return self._merged[name]
+
+    def declared_links_of(self, name: str) -> Tuple[str, ...]:
+        # Targets of the wgLinksTo of a machine, without those of topologies
+        return self._links.get(name, ())
+
+    def is_reciprocal(self, a: str, b: str) -> bool:
+        return (a, b) not in self.non_reciprocal
+
+    def relay_hub(self, name: str) -> Optional[str]:
+        return self._relay_hubs.get(name)
+
+    def relayed_spokes(self, name: str) -> Tuple[str, ...]:
+        # The other spokes of the hub a spoke relays through, which it
+        # reaches through the hub rather than being linked to them
+        hub = self._relay_hubs.get(name)
+        if hub is None:
+            return ()
+        return tuple(spoke for spoke in self._spokes[hub] if spoke != name)
+
+
+def _mk_wg_link_graph(d: Deployment) -> WgLinkGraph:
+
+    # Read wgLinksTo straight from each evaluated machine definition, along
+    # with the wgTopology resource definitions
+    links: Dict[str, Iterable[str]] = {}
+    topologies: List[WgTopology] = []
+    for name, defn in (d.definitions or {}).items():
+        if isinstance(defn, nixops_wg_links.resources.wg_topology.WgTopologyDefinition):
+            topologies.append(
+                WgTopology(
+                    name, defn.topology, defn.machines, defn.hub, defn.k, defn.relay
+                )
+            )
+            continue
+        resource_eval = getattr(defn, "resource_eval", None)
+        if resource_eval is not None and "wgLinksTo" in resource_eval:
+            links[name] = resource_eval["wgLinksTo"]
+    return WgLinkGraph(links, topologies)
+
+
+def wg_link_graph(d: Deployment) -> WgLinkGraph:
+    return _cached_per_deployment(_wg_link_graph, d, _mk_wg_link_graph)
+
+
+def validate_wg_links(
+    machines: Mapping[str, MachineState],
+    wg_keypairs: Mapping[str, nixops_wg_links.resources.wg_keypair.WgKeypairSnapshot],
+    wg_addrs: WgAddressTable,
+    graph: "WgLinkGraph",
+) -> List[str]:
+
+    # Check every link of every configured machine and the addresses of the
+    # whole deployment in one pass, returning all problems found.
+    problems: List[str] = []
+    reported: Set[Any] = set()
+
+    def report(key: Any, problem: str) -> None:
+        if key not in reported:
+            reported.add(key)
+            problems.append(problem)
+
+    for names in wg_addrs.collisions:
+        report(
+            ("collision", tuple(names)),
+            " and ".join(f"‘{name}’ (addr = {wg_addrs[name]})" for name in names)
+            + " have been assigned the same wireguard address.  This can happen by chance if "
+            + "the wg-link for each machine has a different baseIpv4 addresses.  It is recommended "
+            + "to use a single baseIpv4 address for a full deployment.",
         )
 
-    return addr.exploded
+    for problem in graph.problems:
+        report(("topology", problem), problem)
 
+    # Assert the machines of each topology exist
+    for topology in graph.topologies:
+        for name in topology.machines:
+            if name not in machines:
+                report(
+                    ("unknown topology machine", topology.name, name),
+                    f"wireguard topology ‘{topology.name}’ refers to an unknown machine ‘{name}’",
+                )
 
-def to_wg_links_defn(d: Optional[MachineDefinition]) -> WgLinksDefinition:
+    for m in machines.values():
+        # Only machines which will be configured are checked
+        if not m.defn or m.name not in wg_keypairs or not wg_keypairs[m.name].is_up:
+            continue
 
-    if d:
-        e = WgLinksDefinition(d.name, d.resource_eval)
-        e.wgLinksTo = d.resource_eval["wgLinksTo"]
-        return e
-    else:
-        raise TypeError("defn was None")
+        # Assert the machine has an index required for generating a wireguard address
+        if not wg_addrs.has_index(m.name):
+            report(
+                ("index", m.name),
+                f"‘{m.name}’ is missing an optional index required for wg-links",
+            )
+
+        for m2_name in sorted(graph.links_of(m.name)):
+            # Assert the wg-link target exists; unknown machines of
+            # topologies are reported above
+            if m2_name not in machines:
+                if m2_name in graph.declared_links_of(m.name):
+                    report(
+                        ("unknown", m.name, m2_name),
+                        f"‘deployment.wgLinksTo’ in machine ‘{m.name}’ refers to an unknown machine ‘{m2_name}’",
+                    )
+                continue
+
+            # Assert the wg-link doesn't have the same machine at both ends
+            if m2_name == m.name:
+                report(
+                    ("self", m.name),
+                    f"‘deployment.wgLinksTo’ in machine ‘{m.name}’ refers to itself ‘{m2_name}’",
+                )
+                continue
+
+            # Links to target machines whose wgKeypair is not up yet are not configured
+            if m2_name not in wg_keypairs or not wg_keypairs[m2_name].is_up:
+                continue
+
+            # Assert the target machine has an index required for generating a wireguard address
+            if not wg_addrs.has_index(m2_name):
+                report(
+                    ("index", m2_name),
+                    f"‘{m2_name}’ is missing an optional index required for wg-links",
+                )
+
+            # Assert that reciprocal wg links are specified
+            if not graph.is_reciprocal(m.name, m2_name):
+                report(
+                    ("reciprocal", m.name, m2_name),
+                    f"‘{m.name}’ specifies a wg link to ‘{m2_name}’, "
+                    + f"but ‘{m2_name}’ does not specify a wg link to ‘{m.name}’ "
+                    + "and it must for a complete wg-link",
+                )
+
+            # Assert the target has a private address when it is the endpoint
+            pair = tuple(sorted((m.name, m2_name)))
+            local = wg_keypairs[m.name]
+            remote = wg_keypairs[m2_name]
+            if (
+                local.endpoint_address == "private"
+                and not machines[m2_name].private_ipv4
+            ):
+                report(
+                    ("private", m.name, m2_name),
+                    f"‘{m.name}’ (endpointAddress = private) specifies a wg link to ‘{m2_name}’, "
+                    + f"but ‘{m2_name}’ has no private ipv4 address to use as its endpoint",
+                )
+
+            # Assert that both machine endpoints agree on the use of a preshared key
+            if local.use_psk != remote.use_psk:
+                report(
+                    ("use_psk", pair),
+                    f"‘{m.name}’ (usePresharedKey = {local.use_psk}) and "
+                    + f"‘{m2_name}’ (usePresharedKey = {remote.use_psk}) do not "
+                    + "agree on the use of a preshared key, but they must for a functional wg-link",
+                )
+
+            # Assert that both machine endpoints agree on the kind of preshared key
+            elif local.use_psk and local.link_psk != remote.link_psk:
+                report(
+                    ("link_psk", pair),
+                    f"‘{m.name}’ (linkPresharedKeys = {local.link_psk}) and "
+                    + f"‘{m2_name}’ (linkPresharedKeys = {remote.link_psk}) do not "
+                    + "agree on the use of per link preshared keys, but they must for a functional wg-link",
+                )
+
+            # Assert that both machine endpoints agree on the preshared key using one
+            elif local.use_psk and not local.link_psk and local.psk != remote.psk:
+                report(
+                    ("psk", pair),
+                    f"‘{m.name}’ and ‘{m2_name}’ do not agree on the preshared key",
+                )
+
+    return problems
+
+
+def write_wg_keypair_attrs(
+    d: Deployment,
+    wg_keypairs: Mapping[str, nixops_wg_links.resources.wg_keypair.WgKeypairState],
+    writes: Mapping[str, Mapping[str, Any]],
+) -> None:
+
+    # Write collected keypair attribute updates in a single transaction
+    with d._db:
+        for name, attrs in writes.items():
+            for attr, value in attrs.items():
+                setattr(wg_keypairs[name], attr, value)
+
+
+class WgMatrix(NamedTuple):
+    """Physical spec of a deployment, along with the machine specs it was emitted from."""
+
+    attrs: Dict[str, List[Dict[Tuple[str, ...], Any]]]
+    specs: Dict[str, Dict[str, Any]]
 
 
 def mk_matrix(d: Deployment) -> Dict[str, List[Dict[Tuple[str, ...], Any]]]:
+    return wg_matrix(d).attrs
+
+
+def wg_matrix(d: Deployment, dry_run: bool = False) -> WgMatrix:
 
+    # With dry_run, the matrix is computed as a deploy would, but without
+    # uploading keys to machines or writing to the state
     self = d
 
+    if not dry_run:
+        report_wg_keys_synced(self)
+    deploying = wg_deploying(self)
+
     active_machines = self.active_machines
     active_resources = self.active_resources
 
@@ -242,155 +1419,485 @@ def mk_matrix(d: Deployment) -> Dict[str, List[Dict[Tuple[str, ...], Any]]]:
         m.name: [] for m in active_resources.values()
     }
 
-    hosts: DefaultDict[str, DefaultDict[str, List[str]]] = defaultdict(
-        lambda: defaultdict(list)
-    )
+    hosts: Dict[str, Dict[str, List[str]]] = {}
+
+    # Names of the link targets configured as peers of each machine; the
+    # peer records themselves are shared, see peer_records below.
+    total_peers: Dict[str, List[str]] = {m.name: [] for m in active_machines.values()}
+
+    # Matrix computation reads keypair attributes from in-memory snapshots
+    # taken once here; state updates are collected and written back in a
+    # single transaction once the matrix is complete.
+    wg_keypair_state: Dict[
+        str, nixops_wg_links.resources.wg_keypair.WgKeypairState
+    ] = {}
+    wg_keypair_list: Dict[
+        str, nixops_wg_links.resources.wg_keypair.WgKeypairSnapshot
+    ] = {}
+    wg_keypair_writes: DefaultDict[str, Dict[str, Any]] = defaultdict(dict)
+    wg_psk: Dict[str, str] = {}
+
+    # Per-machine wireguard configuration, either reused from state when the
+    # fingerprint of its inputs is unchanged or generated by this run
+    machine_specs: Dict[str, Dict[str, Any]] = {}
+    fingerprints: Dict[str, str] = {}
+    keypair_digests: Dict[str, str] = {}
+
+    with phase("keypair_lookup"):
+        for m in active_machines.values():
+            wg_keypair = findWgKeypair(m, f"{m.name}-wg")
+            if wg_keypair:
+                wg_keypair_state[m.name] = wg_keypair
+                wg_keypair_list[m.name] = wg_keypair.snapshot()
+                # Keypairs with per link preshared keys have no part in the
+                # deployment wide preshared key
+                if not wg_keypair_list[m.name].link_psk:
+                    wg_psk[m.name] = wg_keypair_list[m.name].psk
+
+    with phase("addresses"):
+        wg_addrs = WgAddressTable(wg_keypair_list, active_machines)
+        # Addresses allocated from an ipv4Cidr are kept in state to stay stable
+        for name, snapshot in wg_keypair_list.items():
+            if (
+                snapshot.ipv4_cidr
+                and name in wg_addrs
+                and snapshot.addr != wg_addrs[name]
+            ):
+                wg_keypair_writes[name]["addr"] = wg_addrs[name]
+        graph = wg_link_graph(self)
+        nowg_addrs = NowgAddressTable(
+            (
+                m
+                for m in active_machines.values()
+                if m.defn
+                and m.name in wg_keypair_list
+                and wg_keypair_list[m.name].is_up
+                and (
+                    wg_keypair_list[m.name].add_no_wg_hosts
+                    or wg_keypair_list[m.name].endpoint_address == "auto"
+                )
+            ),
+            active_resources,
+        )
 
-    total_peers: Dict[str, List[Any]] = {m.name: [] for m in active_machines.values()}
+    with phase("psk_consensus"):
+        if any(wg_psk.values()):
+            psk, count = Counter(wg_psk.values()).most_common(1)[0]
+            if count == len(wg_psk):
+                logger.debug("wireguard preshared keys match in nixops state")
+            else:
+                uploads: Dict[
+                    str, Tuple[MachineState, WgKeypairLike, str, str, str]
+                ] = {}
+                for m in active_machines.values():
+                    # Sync key state if m is up, included, public ip is available and psk is not in sync
+                    if (
+                        (m.state == m.UP)
+                        and m.defn
+                        and m.public_ipv4
+                        and m.name in wg_psk
+                        and wg_psk[m.name] != psk
+                    ):
+                        uploads[m.name] = (
+                            m,
+                            wg_keypair_list[m.name],
+                            wg_keypair_list[m.name].private,
+                            wg_keypair_list[m.name].public,
+                            psk,
+                        )
 
-    wg_keypair_list: Dict[str, nixops_wg_links.resources.wg_keypair.WgKeypairState] = {}
-    wg_psk: Dict[str, str] = {}
-    wg_name: Dict[str, str] = {}
-
-    for m in active_machines.values():
-        wg_keypair = findWgKeypair(m, f"{m.name}-wg")
-        if wg_keypair:
-            wg_keypair_list[m.name] = wg_keypair
-            wg_psk[m.name] = wg_keypair.psk
-            wg_name[m.name] = wg_keypair.name
-
-    if any(wg_psk.values()):
-        psk, count = Counter(wg_psk.values()).most_common(1)[0]
-        if count == len(wg_psk):
-            logger.debug("wireguard preshared keys match in nixops state")
-        else:
-            for m in active_machines.values():
-                # Sync key state if m is up, included, public ip is available and psk is not in sync
-                if (
-                    (m.state == m.UP)
-                    and m.defn
-                    and m.public_ipv4
-                    and wg_keypair_list[m.name].psk != psk
-                ):
-                    upload_wg_keypair(
-                        m,
-                        wg_keypair_list[m.name].interface_name,
-                        wg_keypair_list[m.name].private,
-                        wg_keypair_list[m.name].public,
-                        psk,
+                failures = {} if dry_run else upload_wg_keypairs(uploads)
+                for name in uploads:
+                    if name not in failures:
+                        if wg_keypair_list[name].pending_upload:
+                            wg_keypair_writes[name]["pending_upload"] = False
+                        wg_keypair_list[name] = wg_keypair_list[name].replace(
+                            psk=psk, pending_upload=False
+                        )
+                        wg_keypair_writes[name]["psk"] = psk
+
+                if failures:
+                    write_wg_keypair_attrs(self, wg_keypair_state, wg_keypair_writes)
+                    raise Exception(
+                        "unable to sync the wireguard preshared key to "
+                        + ", ".join(f"‘{name}’" for name in sorted(failures))
                     )
-                    wg_keypair_list[m.name].psk = psk
+
+    with phase("link_psks"):
+        # Upload the per link preshared keys of machines in the deploy whose
+        # links changed since their post_wait hook ran, such as links to
+        # keypairs created concurrently with it.  Only these machines are
+        # affected, there is no deployment wide consensus to reach.
+        link_psk_uploads: Dict[
+            str,
+            Tuple[MachineState, WgKeypairLike, Dict[str, Tuple[str, str]], str],
+        ] = {}
+        secret = None
+        for m in active_machines.values():
+            wg_keypair_snapshot = wg_keypair_list.get(m.name)
+            if (
+                dry_run
+                or wg_keypair_snapshot is None
+                or not wg_keypair_snapshot.link_psk
+                or not wg_keypair_snapshot.use_psk
+                or not wg_keypair_snapshot.is_up
+                or m.state != m.UP
+                or not m.defn
+                or not m.public_ipv4
+                or m.name not in deploying
+            ):
+                continue
+            secret = secret or link_psk_secret(self)
+            psks = link_psks(
+                secret,
+                wg_keypair_snapshot.public,
+                {
+                    m2_name: wg_keypair_list[m2_name].public
+                    for m2_name in graph.links_of(m.name)
+                    if m2_name != m.name
+                    and m2_name in wg_keypair_list
+                    and wg_keypair_list[m2_name].public
+                },
+            )
+            digest = link_psks_digest(psks)
+            if digest != wg_keypair_snapshot.link_psk_digest:
+                link_psk_uploads[m.name] = (m, wg_keypair_snapshot, psks, digest)
+
+        (_, failures) = run_parallel(
+            {
+                name: functools.partial(upload_link_psks, m, wg_keypair, psks)
+                for name, (m, wg_keypair, psks, _) in link_psk_uploads.items()
+            }
+        )
+        for name, (_, _, _, digest) in link_psk_uploads.items():
+            if name not in failures:
+                wg_keypair_writes[name]["link_psk_digest"] = digest
+        if failures:
+            write_wg_keypair_attrs(self, wg_keypair_state, wg_keypair_writes)
+            raise Exception(
+                "unable to upload link preshared keys to "
+                + ", ".join(f"‘{name}’" for name in sorted(failures))
+            )
+
+    # Public and private ipv4 of each machine, read from the state once per
+    # matrix rather than once per link they are the target of
+    machine_ipv4s: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+
+    def ipv4s(name: str) -> Tuple[Optional[str], Optional[str]]:
+        if name not in machine_ipv4s:
+            m = active_machines[name]
+            machine_ipv4s[name] = (m.public_ipv4, m.private_ipv4)
+        return machine_ipv4s[name]
+
+    def keypair_digest(name: str) -> Optional[str]:
+        # Hashed once per matrix, however many machines link to the keypair,
+        # so fingerprints only serialize the digests of their peers
+        if name not in wg_keypair_list:
+            return None
+        if name not in keypair_digests:
+            keypair_digests[name] = hashlib.sha256(
+                json.dumps(
+                    mk_keypair_inputs(name), sort_keys=True, default=str
+                ).encode()
+            ).hexdigest()[:16]
+        return keypair_digests[name]
+
+    def mk_keypair_inputs(name: str) -> Dict[str, Any]:
+        wg_keypair = wg_keypair_list[name]
+        m = active_machines[name]
+        (public_ipv4, private_ipv4) = ipv4s(name)
+        return {
+            "state": wg_keypair.state,
+            "public": wg_keypair.public,
+            "psk": wg_keypair.psk,
+            "use_psk": wg_keypair.use_psk,
+            "listen_port": wg_keypair.listen_port,
+            "base_ipv4": wg_keypair.base_ipv4,
+            "ipv4_cidr": wg_keypair.ipv4_cidr,
+            "addr": wg_addrs[name] if name in wg_addrs else None,
+            "index": m.index,
+            "public_ipv4": public_ipv4,
+            "private_ipv4": private_ipv4,
+        }
+
+    def machine_fingerprint(m: nixops.backends.MachineState) -> str:
+        # Everything the configuration of m is generated from: its own
+        # keypair settings, links and host aliases, and the keypair, address
+        # and reciprocal link of each peer and of each wireguard dns server,
+        # the keypairs of peers and dns servers by the digest of their inputs.
+        wg_keypair = wg_keypair_list[m.name]
+        links = sorted(graph.links_of(m.name))
+        dns_machines = [re.sub("-wg$", "", dns) for dns in wg_keypair.dns]
+        inputs = {
+            "format": SPEC_FORMAT,
+            "keypair": keypair_digest(m.name),
+            "config": [
+                getattr(wg_keypair, attr)
+                for attr in (
+                    "name",
+                    "keepalive",
+                    "interface_name",
+                    "dns",
+                    "mtu",
+                    "table",
+                    "pre_up",
+                    "pre_down",
+                    "post_up",
+                    "post_down",
+                    "add_no_wg_hosts",
+                    "hot_reload",
+                    "link_psk",
+                    "endpoint_address",
+                )
+            ],
+            "relay": [
+                graph.relay_hub(m.name),
+                m.name in graph.relays,
+                {name: keypair_digest(name) for name in graph.relayed_spokes(m.name)},
+            ],
+            "nowg": nowg_addrs.digest(m.name)
+            if wg_keypair.add_no_wg_hosts or wg_keypair.endpoint_address == "auto"
+            else None,
+            "links": {
+                m2_name: [
+                    keypair_digest(m2_name),
+                    graph.is_reciprocal(m2_name, m.name),
+                ]
+                if m2_name in active_machines
+                else None
+                for m2_name in links
+            },
+            "dns": {
+                name: keypair_digest(name)
+                for name in dns_machines
+                if name in active_machines
+            },
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    # Peer records and host alias lists are built once and referenced from
+    # every machine they appear in, rather than copied per (machine, peer)
+    # pair.  A peer record only depends on the target and the peer settings
+    # of the local machine, which are uniform in most deployments, so the
+    # machines sharing settings share a table of records by target: each
+    # record is built once, and the peers of a machine, reused from state
+    # or not, are looked up from its table.  Nothing may mutate these once
+    # they are handed out.
+    peer_settings: Dict[str, PeerSettings] = {}
+    peer_tables: Dict[PeerSettings, Dict[str, Dict[str, Any]]] = {}
+    peer_digest_tables: Dict[PeerSettings, Dict[str, str]] = {}
+    host_aliases: Dict[str, List[str]] = {}
+
+    def peer_endpoint_host(m_name: str, m2_name: str) -> Optional[str]:
+        # From the addresses resolved for this matrix only, rather than the
+        # state, as it is looked up for every (machine, peer) pair
+        endpoint_address = wg_keypair_list[m_name].endpoint_address
+        (public_ipv4, private_ipv4) = ipv4s(m2_name)
+        if endpoint_address == "private":
+            return private_ipv4
+        if endpoint_address == "auto":
+            return nowg_addrs.address(m_name, m2_name) or public_ipv4
+        return public_ipv4
+
+    def mk_peer_settings(m_name: str) -> PeerSettings:
+        wg_keypair = wg_keypair_list[m_name]
+        keepalive = (
+            wg_keypair.keepalive if 1 <= (wg_keypair.keepalive or 0) <= 65535 else None
+        )
+        if not wg_keypair.use_psk:
+            psk = None
+        elif wg_keypair.link_psk:
+            psk = "link"
+        else:
+            psk = "deployment"
+        # Auto endpoints are the addresses seen from the scope of the machine
+        endpoint_address = wg_keypair.endpoint_address
+        scope = nowg_addrs.scope(m_name) if endpoint_address == "auto" else None
+        # Spokes of a relaying hub route the whole wireguard network through it
+        hub = graph.relay_hub(m_name)
+        relay_network = str(wg_addrs.network(m_name)) if hub else None
+        return (keepalive, psk, endpoint_address, scope, hub, relay_network)
+
+    def peer_table(m_name: str) -> Tuple[PeerSettings, Dict[str, Dict[str, Any]]]:
+        if m_name not in peer_settings:
+            peer_settings[m_name] = mk_peer_settings(m_name)
+        settings = peer_settings[m_name]
+        if settings not in peer_tables:
+            peer_tables[settings] = {}
+        return (settings, peer_tables[settings])
+
+    def mk_peer_record(
+        settings: PeerSettings, m_name: str, m2_name: str
+    ) -> Dict[str, Any]:
+        (keepalive, psk, _, _, hub, relay_network) = settings
+        if psk == "link":
+            psk_file: Optional[str] = link_psk_file(m2_name)
+        elif psk == "deployment":
+            psk_file = "/etc/nixops-wg-links/wireguard.psk"
+        else:
+            psk_file = None
+        allowed_ip = relay_network if hub == m2_name else f"{wg_addrs[m2_name]}/32"
+        endpoint_host = peer_endpoint_host(m_name, m2_name)
+        return {
+            "publicKey": wg_keypair_list[m2_name].public,
+            "allowedIPs": [allowed_ip],
+            "endpoint": f"{endpoint_host}:{wg_keypair_list[m2_name].listen_port}",
+            "persistentKeepalive": keepalive,
+            "presharedKeyFile": psk_file,
+        }
+
+    def peer_records(m_name: str, m2_names: List[str]) -> List[Dict[str, Any]]:
+        (settings, records) = peer_table(m_name)
+        for m2_name in m2_names:
+            if m2_name not in records:
+                records[m2_name] = mk_peer_record(settings, m_name, m2_name)
+        return [records[m2_name] for m2_name in m2_names]
+
+    def peer_digests(m_name: str, m2_names: List[str]) -> List[str]:
+        # Short digests of peer records, kept in the spec in place of the
+        # records themselves
+        (settings, _) = peer_table(m_name)
+        digests = peer_digest_tables.setdefault(settings, {})
+        for m2_name, record in zip(m2_names, peer_records(m_name, m2_names)):
+            if m2_name not in digests:
+                digests[m2_name] = hashlib.sha256(
+                    json.dumps(record, sort_keys=True).encode()
+                ).hexdigest()[:16]
+        return [digests[m2_name] for m2_name in m2_names]
+
+    def host_alias(alias: str) -> List[str]:
+        if alias not in host_aliases:
+            host_aliases[alias] = [alias]
+        return host_aliases[alias]
+
+    def add_host(machine_hosts: Dict[str, List[str]], ip: str, alias: str) -> None:
+        # Addresses shared by several hosts get a merged list of their own
+        if ip in machine_hosts:
+            machine_hosts[ip] = machine_hosts[ip] + [alias]
+        else:
+            machine_hosts[ip] = host_alias(alias)
 
     def do_machine(m: nixops.backends.MachineState) -> None:
         # Skip configuration if the machine is excluded or the associated wgKeypair is not up yet
         if (
             not m.defn
             or m.name not in wg_keypair_list
-            or (wg_keypair_list[m.name].state != wg_keypair_list[m.name].UP)
+            or not wg_keypair_list[m.name].is_up
         ):
             return
 
-        wg_local_ipv4 = index_to_private_ip(wg_keypair_list[m.name], m.index)
-        defn = to_wg_links_defn(m.defn)
+        # Reuse the configuration from state if none of its inputs changed
+        fingerprint = machine_fingerprint(m)
+        spec = wg_keypair_list[m.name].spec
+        if spec and wg_keypair_list[m.name].spec_fingerprint == fingerprint:
+            machine_specs[m.name] = spec
+            return
+        fingerprints[m.name] = fingerprint
+
+        wg_local_ipv4 = wg_addrs[m.name]
 
         # Emit configuration to realise wg peer-to-peer links.
-        for r2 in active_resources.values():
-            ip = m.address_to(r2)
-            if ip and wg_keypair_list[m.name].add_no_wg_hosts:
-                hosts[m.name][ip] += [r2.name + "-nowg"]
+        machine_hosts = hosts[m.name] = (
+            dict(nowg_addrs.hosts(m.name))
+            if wg_keypair_list[m.name].add_no_wg_hosts
+            else {}
+        )
 
-        for m2_name in defn.wgLinksTo:
+        for m2_name in graph.links_of(m.name):
             m2 = active_machines[m2_name]
 
             # Skip configuration of target machines the associated wgKeypair is not up yet
-            if wg_keypair_list[m2.name].state != wg_keypair_list[m2.name].UP:
+            if m2.name not in wg_keypair_list or not wg_keypair_list[m2.name].is_up:
                 continue
 
-            # Assert the wg-link target exists
-            if m2.name not in active_machines:
-                raise Exception(
-                    f"‘deployment.wgLinksTo’ in machine ‘{m.name}’ refers to an unknown machine ‘{m2.name}’"
-                )
-
-            # Assert the wg-link doesn't have the same machine at both ends
-            if m2.name == m.name:
-                raise Exception(
-                    f"‘deployment.wgLinksTo’ in machine ‘{m.name}’ refers to itself ‘{m2.name}’"
-                )
-
-            # Assert both machine endpoints have an index required for generating a wireguard address
-            if not isinstance(m.index, int):
-                raise ValueError(
-                    f"‘{m.name}’ is missing an optional index required for wg-links"
-                )
-            if not isinstance(m2.index, int):
-                raise ValueError(
-                    f"‘{m2.name}’ is missing an optional index required for wg-links"
-                )
-
-            # Assert that reciprocal wg links are specified
-            if (
-                m.name
-                not in to_wg_links_defn(
-                    self._machine_definition_for_required(m2.name)
-                ).wgLinksTo
-            ):
-                raise ValueError(
-                    f"‘{m.name}’ specifies a wg link to ‘{m2.name}’, "
-                    + f"but ‘{m2.name}’ does not specify a wg link to ‘{m.name}’"
-                    + "and it must for a complete wg-link"
-                )
-
-            # Assert that both machine endpoints agree on the use of a preshared key
-            if wg_keypair_list[m.name].use_psk != wg_keypair_list[m2.name].use_psk:
-                raise ValueError(
-                    f"‘{m.name}’ (usePresharedKey = {wg_keypair_list[m.name].use_psk}) and "
-                    + f"‘{m2.name}’ (usePresharedKey = {wg_keypair_list[m2.name].use_psk}) do not"
-                    + "agree on the use of a preshared key, but they must for a functional wg-link"
-                )
+            total_peers[m.name].append(m2.name)
+            add_host(machine_hosts, wg_addrs[m2.name], m2.name + "-wg")
 
-            # Assert that both machine endpoints agree on the preshared key using one
-            if wg_keypair_list[m.name].use_psk and (
-                wg_keypair_list[m.name].psk != wg_keypair_list[m2.name].psk
-            ):
-                raise ValueError(
-                    f"‘{m.name}’ and ‘{m2.name}’ do not agree on the preshared key"
-                )
+        # Spokes of a relaying hub reach the other spokes of the hub by their
+        # wireguard address too, through their single peer
+        if graph.relay_hub(m.name) in total_peers[m.name]:
+            linked = set(total_peers[m.name])
+            for m2_name in graph.relayed_spokes(m.name):
+                if (
+                    m2_name not in linked
+                    and m2_name in wg_keypair_list
+                    and wg_keypair_list[m2_name].is_up
+                ):
+                    add_host(machine_hosts, wg_addrs[m2_name], m2_name + "-wg")
 
-            wg_remote_ipv4 = index_to_private_ip(wg_keypair_list[m2.name], m2.index)
+        # Always use the wg/nowg suffixes for aliases
+        if wg_keypair_list[m.name].addr != wg_local_ipv4:
+            wg_keypair_writes[m.name]["addr"] = wg_local_ipv4
+        add_host(machine_hosts, "127.0.0.1", m.name)
+        add_host(machine_hosts, wg_local_ipv4, m.name + "-wg")
+
+    # Report every link and address problem of the deployment at once,
+    # before any configuration is generated
+    with phase("validation"):
+        problems = validate_wg_links(active_machines, wg_keypair_list, wg_addrs, graph)
+    if problems:
+        raise ValueError(
+            f"wg-links configuration has {len(problems)} problem(s):\n"
+            + "\n".join(f"  - {problem}" for problem in problems)
+        )
 
-            # Assert that both machine endpoints don't have an ipv4 collision due to base_ipv4 skew
-            if wg_local_ipv4 == wg_remote_ipv4:
-                raise ValueError(
-                    f"‘{m.name}’ (addr = {wg_local_ipv4}) and ‘{m2.name}’ (addr = {wg_remote_ipv4}) "
-                    + "have been assigned the same wireguard address.  This can happen by chance if "
-                    + "the wg-link for each machine has a different baseIpv4 addresses.  It is recommended "
-                    + "to use a single baseIpv4 address for a full deployment."
-                )
+    with phase("do_machine"):
+        for m in active_machines.values():
+            do_machine(m)
 
-            total_peers[m.name].append(
-                {
-                    "publicKey": wg_keypair_list[m2.name].public,
-                    "allowedIPs": [f"{wg_remote_ipv4}/32"],
-                    "endpoint": f"{m2.public_ipv4}:{wg_keypair_list[m2.name].listen_port}",
-                    "persistentKeepalive": wg_keypair_list[m.name].keepalive
-                    if 1 <= (wg_keypair_list[m.name].keepalive or 0) <= 65535
-                    else None,
-                    "presharedKeyFile": "/etc/nixops-wg-links/wireguard.psk"
-                    if wg_keypair_list[m.name].use_psk
-                    else None,
-                }
-            )
+    def mk_machine_spec(r: nixops.backends.GenericMachineState) -> Dict[str, Any]:
+        # Sort the hosts by its canonical host names.
+        sorted_hosts = sorted(hosts[r.name].items(), key=lambda item: item[1][0])
 
-            hosts[m.name][wg_remote_ipv4] += [m2.name + "-wg"]
+        # Just to remember the format:
+        #   ip_address canonical_hostname [aliases...]
+        extra_hosts = {f"{ip}": names for ip, names in sorted_hosts}
 
-        # Always use the wg/nowg suffixes for aliases
-        wg_keypair_list[m.name].addr = wg_local_ipv4
-        hosts[m.name]["127.0.0.1"].append(m.name)
-        hosts[m.name][wg_local_ipv4].append(m.name + "-wg")
+        # Add the base wireguard nix config for machine m
+        wg_local_ipv4 = wg_addrs[r.name]
 
-    for m in active_machines.values():
-        do_machine(m)
+        # Substitute wireguard IPs for any wg-link resources name in the dns list
+        if wg_keypair_list[r.name].dns != []:
+            dns_list = cast(List[str], wg_keypair_list[r.name].dns).copy()
+            wg_keypairs = wg_keypair_index(self)
+            for i, dns in enumerate(wg_keypair_list[r.name].dns):
+                dns_machine = re.sub("-wg$", "", dns)
+                if (
+                    dns in wg_keypairs
+                    and dns_machine in wg_keypair_list
+                    and wg_keypair_list[dns_machine].is_up
+                ):
+                    del dns_list[i]
+                    dns_list.insert(i, wg_addrs[dns_machine])
+        else:
+            dns_list = []
+
+        return {
+            "hosts": extra_hosts,
+            "settings": {
+                "interfaceName": wg_keypair_list[r.name].interface_name,
+                "ipForward": r.name in graph.relays,
+                "hotReload": bool(wg_keypair_list[r.name].hot_reload),
+            },
+            "interface": {
+                "address": [f"{wg_local_ipv4}/{wg_addrs.prefixlen(r.name)}"],
+                "listenPort": wg_keypair_list[r.name].listen_port,
+                "privateKeyFile": "/etc/nixops-wg-links/wireguard.private",
+                "dns": dns_list,
+                "mtu": wg_keypair_list[r.name].mtu
+                if (wg_keypair_list[r.name].mtu or 0) >= 1
+                else None,
+                "preUp": wg_keypair_list[r.name].pre_up,
+                "preDown": wg_keypair_list[r.name].pre_down,
+                "postUp": wg_keypair_list[r.name].post_up,
+                "postDown": wg_keypair_list[r.name].post_down,
+                "table": wg_keypair_list[r.name].table,
+            },
+            "peers": total_peers[r.name],
+            "peerDigests": peer_digests(r.name, total_peers[r.name]),
+        }
 
     def emit_resource(r: nixops.resources.ResourceState) -> None:
         config = attrs_per_resource[r.name]
@@ -402,72 +1909,87 @@ def mk_matrix(d: Deployment) -> Dict[str, List[Dict[Tuple[str, ...], Any]]]:
             if (
                 not r.defn
                 or r.name not in wg_keypair_list
-                or (wg_keypair_list[r.name].state != wg_keypair_list[r.name].UP)
+                or not wg_keypair_list[r.name].is_up
             ):
                 return
 
-            # Sort the hosts by its canonical host names.
-            sorted_hosts = sorted(hosts[r.name].items(), key=lambda item: item[1][0])
-
-            # Just to remember the format:
-            #   ip_address canonical_hostname [aliases...]
-            extra_hosts = {f"{ip}": names for ip, names in sorted_hosts}
-
-            # Add the base wireguard nix config for machine m
-            wg_local_ipv4 = index_to_private_ip(wg_keypair_list[r.name], r.index)
-
-            # Substitute wireguard IPs for any wg-link resources name in the dns list
-            if wg_keypair_list[r.name].dns != []:
-                dns_list = cast(List[str], wg_keypair_list[r.name].dns).copy()
-                for i, dns in enumerate(wg_keypair_list[r.name].dns):
-                    if dns in wg_name.values():
-                        del dns_list[i]
-                        dns_list.insert(
-                            i,
-                            index_to_private_ip(
-                                wg_keypair_list[re.sub("-wg$", "", dns)],
-                                active_machines[re.sub("-wg$", "", dns)].index,
-                            ),
-                        )
-            else:
-                dns_list = []
-
-            config.append(
-                {
-                    ("networking", "hosts"): extra_hosts,
-                    ("networking", "firewall", "allowedUDPPorts"): [
-                        wg_keypair_list[r.name].listen_port
-                    ],
+            # The spec kept in state is the one last deployed to the machine
+            if r.name not in machine_specs:
+                machine_specs[r.name] = mk_machine_spec(r)
+                if r.name in deploying:
+                    wg_keypair_writes[r.name]["spec"] = machine_specs[r.name]
+                    wg_keypair_writes[r.name]["spec_fingerprint"] = fingerprints[r.name]
+            spec = machine_specs[r.name]
+            wg_keypair = wg_keypair_list[r.name]
+            peers = peer_records(r.name, spec["peers"])
+
+            machine_config: Dict[Tuple[str, ...], Any] = {
+                ("networking", "hosts"): spec["hosts"],
+                ("networking", "firewall", "allowedUDPPorts"): [wg_keypair.listen_port],
+                (
+                    "networking",
+                    "wg-quick",
+                    "interfaces",
+                    wg_keypair.interface_name,
+                ): spec["interface"],
+            }
+            if r.name in graph.relays:
+                # Hubs forward traffic between the spokes relaying through them
+                sysctl = ("boot", "kernel", "sysctl", "net.ipv4.ip_forward")
+                machine_config[sysctl] = 1
+            if wg_keypair.hot_reload:
+                # Peers are configured on the running interface by a service
+                # of their own, leaving the wg-quick unit unchanged
+                machine_config[
                     (
-                        "networking",
-                        "wg-quick",
-                        "interfaces",
-                        wg_keypair_list[r.name].interface_name,
-                    ): {
-                        "address": [f"{wg_local_ipv4}/24"],
-                        "listenPort": wg_keypair_list[r.name].listen_port,
-                        "privateKeyFile": "/etc/nixops-wg-links/wireguard.private",
-                        "dns": dns_list,
-                        "mtu": wg_keypair_list[r.name].mtu
-                        if (wg_keypair_list[r.name].mtu or 0) >= 1
-                        else None,
-                        "preUp": wg_keypair_list[r.name].pre_up,
-                        "preDown": wg_keypair_list[r.name].pre_down,
-                        "postUp": wg_keypair_list[r.name].post_up,
-                        "postDown": wg_keypair_list[r.name].post_down,
-                        "table": wg_keypair_list[r.name].table,
-                    },
+                        "systemd",
+                        "services",
+                        f"wg-links-peers-{wg_keypair.interface_name}",
+                    )
+                ] = wg_peers_service(wg_keypair.interface_name, wg_keypair.table, peers)
+            else:
+                machine_config[
                     (
                         "networking",
                         "wg-quick",
                         "interfaces",
-                        wg_keypair_list[r.name].interface_name,
+                        wg_keypair.interface_name,
                         "peers",
-                    ): total_peers[r.name],
-                }
-            )
+                    )
+                ] = peers
+            config.append(machine_config)
+
+    def report_endpoint_paths() -> None:
+        # Log which links reach their peer at its private address, when any
+        # keypair selects endpoints other than the public addresses
+        if all(
+            wg_keypair_list[name].endpoint_address == "public" for name in machine_specs
+        ):
+            return
+        links = 0
+        private: Dict[str, List[str]] = {}
+        for name, spec in machine_specs.items():
+            links += len(spec["peers"])
+            if wg_keypair_list[name].endpoint_address == "public":
+                continue
+            for m2_name in spec["peers"]:
+                (_, private_ipv4) = ipv4s(m2_name)
+                if private_ipv4 and peer_endpoint_host(name, m2_name) == private_ipv4:
+                    private.setdefault(name, []).append(m2_name)
+        for name, peers in sorted(private.items()):
+            logger.debug(f"‘{name}’ reaches {', '.join(peers)} at private addresses")
+        logger.info(
+            f"{sum(len(peers) for peers in private.values())} of {links} wireguard link(s) "
+            + "use private endpoint addresses, the others public addresses"
+        )
+
+    with phase("emit_resource"):
+        for r in active_resources.values():
+            emit_resource(r)
+        report_endpoint_paths()
 
-    for r in active_resources.values():
-        emit_resource(r)
+    if not dry_run:
+        with phase("write_state"):
+            write_wg_keypair_attrs(self, wg_keypair_state, wg_keypair_writes)
 
-    return attrs_per_resource
+    return WgMatrix(attrs_per_resource, machine_specs)
@@ -7,6 +7,8 @@
   resources = { evalResources, zipAttrs, resourcesByType, ... }: {
     wgKeypair = evalResources ./wg-keypair.nix
       (zipAttrs resourcesByType.wgKeypair or [ ]);
+    wgTopology = evalResources ./wg-topology.nix
+      (zipAttrs resourcesByType.wgTopology or [ ]);
   };
 
 }
@@ -69,8 +69,9 @@ with lib; {
       description = ''
         Whether to sync the wireguard key state from nixops state to machine.
         This will add some ssh overhead, but will fix any missing or inconsistent wireguard
-        keypair state on deployment machines.  Use of this option will also force a
-        restart of the wireguard systemd service to use the syncronized state keys.
+        keypair state on deployment machines.  Keys on the machine are compared against
+        nixops state first and are only re-uploaded if they differ, in which case the
+        wireguard systemd service is also restarted to use the syncronized state keys.
       '';
     };
 
@@ -164,6 +165,22 @@ with lib; {
       '';
     };
 
+    ipv4Cidr = mkOption {
+      default = null;
+      example = "10.100.0.0/16";
+      type = types.nullOr types.str;
+      description = ''
+        A private IPv4 network to allocate the wireguard IPv4 address of this keypair from,
+        instead of deriving it from baseIpv4 and the machine index.  The prefix length of
+        the network is also used for the wireguard interface address, instead of /24.
+
+        Allocated addresses are saved in nixops state and kept for as long as the keypair
+        exists, regardless of changes to machine indexes, and machines added later are
+        given the lowest address of the network not yet in use.  Use a single ipv4Cidr,
+        such as a /16, for a full deployment to scale beyond 254 machines.
+      '';
+    };
+
     addNoWgHosts = mkOption {
       default = true;
       type = types.bool;
@@ -172,6 +189,47 @@ with lib; {
         with a suffix of "-nowg" appended.
       '';
     };
+
+    hotReload = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Whether to apply wireguard key and peer changes to the running interface
+        with "wg set" instead of restarting the wg-quick service.
+
+        When enabled, peers are configured by a separate "wg-links-peers-<interfaceName>"
+        systemd service which is reloaded, rather than restarted, on peer changes,
+        and uploaded keys are set on the running interface.  Changes to interface
+        level options such as the address, listenPort or mtu still restart wg-quick.
+      '';
+    };
+
+    linkPresharedKeys = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Whether to use a different preshared key for each link, instead of one
+        preshared key shared by the whole deployment.  The key of a link is derived
+        from a secret kept in the nixops deployment state and the public keys of both
+        ends of the link, and is uploaded to /etc/nixops-wg-links/psk.d/<peer>.psk.
+
+        Both ends of a link must agree on this option.  A recreated keypair then only
+        changes the keys of its own links, and is left out of the deployment wide
+        preshared key sync.  Has no effect unless usePresharedKey is enabled.
+      '';
+    };
+
+    endpointAddress = mkOption {
+      default = "public";
+      type = types.enum [ "public" "private" "auto" ];
+      description = ''
+        The address of each peer to use as its wireguard endpoint: its public ipv4
+        address, its private ipv4 address, or "auto" for the address nixops uses to
+        reach the peer from this machine, which is the private address between
+        machines of the same cloud region for backends supporting it, and the public
+        address otherwise.
+      '';
+    };
   };
   config._type = "wg-keypair";
 }
@@ -0,0 +1,63 @@
+{ config, lib, uuid, name, ... }:
+with lib; {
+  options = {
+    topology = mkOption {
+      type = types.enum [ "mesh" "star" "ring" "knearest" ];
+      example = "star";
+      description = ''
+        The pattern of wireguard links to set up between the listed machines:
+
+        mesh: every machine is linked to every other machine.
+        star: every machine is linked to the hub machine only, and the hub to every machine.
+        ring: every machine is linked to the machines before and after it in the list,
+              wrapping around at the ends.
+        knearest: every machine is linked to the k machines before and the k machines
+              after it in the list, wrapping around at the ends.
+
+        Links are set up in both directions and are merged with those declared by
+        deployment.wgLinksTo, which is not needed for machines listed here.
+      '';
+    };
+
+    machines = mkOption {
+      type = types.listOf types.str;
+      example = [ "machine1" "machine2" "machine3" ];
+      description = ''
+        The names of the machines to link.  Each machine needs a wireguard keypair
+        resource named after it with a "-wg" suffix, as with deployment.wgLinksTo.
+      '';
+    };
+
+    hub = mkOption {
+      type = types.nullOr types.str;
+      default = null;
+      example = "machine1";
+      description =
+        "The hub machine of a star topology, which must be one of the listed machines.";
+    };
+
+    k = mkOption {
+      type = types.addCheck types.int (x: x >= 1);
+      default = 1;
+      description = ''
+        The number of machines on each side of a machine in the list it is linked to,
+        for a knearest topology.  A k of 1 is the same as a ring.
+      '';
+    };
+
+    relay = mkOption {
+      type = types.bool;
+      default = false;
+      description = ''
+        Whether the hub of a star topology relays traffic between its spokes.
+
+        When enabled, each spoke has the hub as its single peer, with the allowed IPs of
+        that peer covering the whole wireguard network of the spoke rather than the hub
+        address alone, and the hub has IPv4 forwarding enabled.  Spokes then reach each
+        other by their wireguard addresses through the hub, while keeping a peer table
+        of a single entry.
+      '';
+    };
+  };
+  config._type = "wg-topology";
+}
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Plan of the wireguard configuration changes a deploy would make.
+#
+# The physical spec is generated as a deploy would, without uploading keys or
+# writing to the state, and the configuration of each machine is compared
+# against the one last deployed to it.  Only the machines whose wireguard
+# configuration changed need to be included in the next deploy:
+#
+#   nixops wg-links-plan -d $DEPLOYMENT [--json]
+
+from nixops.deployment import Deployment
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+import argparse
+import json
+import logging
+import sys
+
+from . import setup_logging
+from .lib import wg_keypair_index, wg_matrix
+
+logger = logging.getLogger(__name__)
+
+CHANGE_ADDED = "added"
+CHANGE_REMOVED = "removed"
+CHANGE_CHANGED = "changed"
+
+# Sections of the machine spec compared key by key
+SPEC_SECTIONS = ("settings", "interface", "hosts")
+
+
+class WgConfigChange(NamedTuple):
+    """A change to the wireguard configuration of a machine."""
+
+    machine: str
+    path: str
+    change: str
+    old: Any
+    new: Any
+
+
+def diff_mapping(
+    machine: str, section: str, old: Mapping[str, Any], new: Mapping[str, Any]
+) -> List[WgConfigChange]:
+
+    changes: List[WgConfigChange] = []
+    for key in sorted(set(old) | set(new)):
+        path = f"{section}.{key}"
+        if key not in old:
+            changes.append(WgConfigChange(machine, path, CHANGE_ADDED, None, new[key]))
+        elif key not in new:
+            changes.append(
+                WgConfigChange(machine, path, CHANGE_REMOVED, old[key], None)
+            )
+        elif old[key] != new[key]:
+            changes.append(
+                WgConfigChange(machine, path, CHANGE_CHANGED, old[key], new[key])
+            )
+    return changes
+
+
+def diff_specs(
+    machine: str, old: Optional[Dict[str, Any]], new: Dict[str, Any]
+) -> List[WgConfigChange]:
+
+    # Specs kept by older versions of the plugin hold no peer digests or
+    # settings, so there is nothing to compare the machine against
+    if not old or "settings" not in old:
+        return [WgConfigChange(machine, "spec", CHANGE_ADDED, None, None)]
+
+    changes: List[WgConfigChange] = []
+    for section in SPEC_SECTIONS:
+        changes.extend(diff_mapping(machine, section, old[section], new[section]))
+
+    # Peer records are compared by digest, the records themselves not being
+    # kept in state
+    old_peers = dict(zip(old["peers"], old["peerDigests"]))
+    new_peers = dict(zip(new["peers"], new["peerDigests"]))
+    for change in diff_mapping(machine, "peers", old_peers, new_peers):
+        changes.append(change._replace(old=None, new=None))
+    if old_peers == new_peers and old["peers"] != new["peers"]:
+        changes.append(
+            WgConfigChange(machine, "peers", CHANGE_CHANGED, old["peers"], new["peers"])
+        )
+    return changes
+
+
+def plan_deployment(d: Deployment) -> Tuple[List[WgConfigChange], List[str]]:
+
+    # Changes of every machine, and the machines to include in a deploy
+    wg_keypairs = wg_keypair_index(d)
+    matrix = wg_matrix(d, dry_run=True)
+
+    changes: List[WgConfigChange] = []
+    for name in sorted(matrix.specs):
+        changes.extend(
+            diff_specs(name, wg_keypairs[f"{name}-wg"].spec, matrix.specs[name])
+        )
+    include = sorted({change.machine for change in changes})
+    logger.debug(
+        f"{len(include)} of {len(matrix.specs)} machine(s) have wireguard configuration changes"
+    )
+    return (changes, include)
+
+
+def format_change(change: WgConfigChange) -> str:
+    if change.path == "spec":
+        return "  + (no configuration recorded as deployed)"
+    if change.path.startswith("peers."):
+        symbol = {CHANGE_ADDED: "+", CHANGE_REMOVED: "-", CHANGE_CHANGED: "~"}
+        return f"  {symbol[change.change]} {change.path}"
+    if change.change == CHANGE_ADDED:
+        return f"  + {change.path}: {json.dumps(change.new)}"
+    if change.change == CHANGE_REMOVED:
+        return f"  - {change.path}: {json.dumps(change.old)}"
+    return f"  ~ {change.path}: {json.dumps(change.old)} -> {json.dumps(change.new)}"
+
+
+def format_changes(changes: List[WgConfigChange]) -> str:
+
+    lines: List[str] = []
+    machine = None
+    for change in changes:
+        if change.machine != machine:
+            machine = change.machine
+            lines.append(machine)
+        lines.append(format_change(change))
+    return "\n".join(lines)
+
+
+def op_wg_links_plan(args: Any) -> None:
+    from nixops.script_defs import network_state, open_deployment
+
+    setup_logging()
+    with network_state(args) as sf:
+        depl = open_deployment(sf, args)
+        depl.evaluate_active()
+        (changes, include) = plan_deployment(depl)
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "changes": [change._asdict() for change in changes],
+                    "include": include,
+                },
+                indent=2,
+            )
+        )
+    elif include:
+        print(format_changes(changes))
+        sys.stderr.write(
+            f"{len(include)} machine(s) have wireguard configuration changes, deploy them with:\n"
+        )
+        print("nixops deploy --include " + " ".join(include))
+    else:
+        sys.stderr.write("No wireguard configuration changes to deploy\n")
+
+
+def add_parser(subparsers: argparse._SubParsersAction) -> None:
+    from nixops.script_defs import add_subparser
+
+    subparser = add_subparser(
+        subparsers,
+        "wg-links-plan",
+        help="show the wireguard configuration changes a deploy would make",
+    )
+    subparser.set_defaults(op=op_wg_links_plan)
+    subparser.add_argument(
+        "--json", action="store_true", help="print the changes as JSON"
+    )
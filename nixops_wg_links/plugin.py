@@ -4,18 +4,30 @@ from nixops.deployment import Deployment
 from nixops.backends import MachineState
 from nixops.plugins import Plugin, MachineHooks, DeploymentHooks
 
+from . import setup_logging
+from .instrumentation import instrument
 from .lib import generate_wg_keypair
 from .lib import mk_matrix
+from .remote import close_transport
 
 
 class WgLinksMachineHooks(MachineHooks):
     def post_wait(self, m: MachineState) -> None:
-        generate_wg_keypair(m)
+        setup_logging()
+        with instrument("generate_wg_keypair", m.depl, m.name):
+            generate_wg_keypair(m)
 
 
 class WgLinksDeploymentHooks(DeploymentHooks):
     def physical_spec(self, d: Deployment):
-        return mk_matrix(d)
+        setup_logging()
+        try:
+            with instrument("mk_matrix", d):
+                return mk_matrix(d)
+        finally:
+            # The post_wait hooks of the deploy have all run by now, so the
+            # remote commands of the plugin are done with
+            close_transport(d)
 
 
 class NixopsWgLinksPlugin(Plugin):
@@ -35,9 +47,20 @@ class NixopsWgLinksPlugin(Plugin):
 
     @staticmethod
     def load():
-        return ["nixops_wg_links.resources.wg_keypair"]
+        return [
+            "nixops_wg_links.resources.wg_keypair",
+            "nixops_wg_links.resources.wg_topology",
+        ]
 
 
 @nixops.plugins.hookimpl
 def plugin():
     return NixopsWgLinksPlugin()
+
+
+@nixops.plugins.hookimpl
+def parser(parser, subparsers):
+    from . import plan, probe
+
+    plan.add_parser(subparsers)
+    probe.add_parser(subparsers)
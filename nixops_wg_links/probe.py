@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+# Fleet-wide health probe of the wireguard links of a deployment.
+#
+# The dump of the wireguard interface of every linked machine is collected
+# concurrently, one remote command per machine, and each link declared by
+# deployment.wgLinksTo is checked for a recent handshake with its peer:
+#
+#   nixops wg-links-probe -d $DEPLOYMENT [--max-age 180] [--json]
+
+from nixops.deployment import Deployment
+from nixops.backends import MachineState
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import argparse
+import functools
+import json
+import logging
+import shlex
+import sys
+
+from . import remote, setup_logging
+from .lib import run_parallel, wg_keypair_index, wg_link_graph
+
+logger = logging.getLogger(__name__)
+
+# Age in seconds after which wireguard considers a handshake expired
+DEFAULT_MAX_AGE = 180
+
+# Link status values, all but LINK_OK are flagged
+LINK_OK = "ok"
+LINK_STALE = "stale"
+LINK_NO_HANDSHAKE = "no-handshake"
+LINK_NO_PEER = "no-peer"
+LINK_UNREACHABLE = "unreachable"
+
+# Network path of a link, by the address of the target used as its endpoint
+PATH_PRIVATE = "private"
+PATH_PUBLIC = "public"
+PATH_OTHER = "other"
+
+
+class WgPeerStatus(NamedTuple):
+    """A peer entry of a wireguard interface dump."""
+
+    public_key: str
+    endpoint: Optional[str]
+    allowed_ips: List[str]
+    latest_handshake: int
+    transfer_rx: int
+    transfer_tx: int
+
+
+class WgInterfaceDump(NamedTuple):
+    """Parsed dump of a wireguard interface, along with the machine clock."""
+
+    now: int
+    public_key: str
+    listen_port: int
+    peers: Dict[str, WgPeerStatus]
+
+
+class WgLinkStatus(NamedTuple):
+    """Health of one declared wireguard link, as seen from its source machine."""
+
+    source: str
+    target: str
+    status: str
+    handshake_age: Optional[int]
+    transfer_rx: Optional[int]
+    transfer_tx: Optional[int]
+    error: Optional[str]
+    endpoint: Optional[str] = None
+    path: Optional[str] = None
+
+
+def probe_command(interface_name: str) -> str:
+    # The machine clock is included to age handshakes without clock skew
+    return f"date +%s && wg show {shlex.quote(interface_name)} dump"
+
+
+def parse_wg_dump(output: str) -> WgInterfaceDump:
+
+    # Output of probe_command: the time, then the tab separated interface line
+    #   private-key public-key listen-port fwmark
+    # followed by one line per peer
+    #   public-key preshared-key endpoint allowed-ips latest-handshake
+    #   transfer-rx transfer-tx persistent-keepalive
+    lines = [line for line in output.splitlines() if line.strip()]
+    if len(lines) < 2:
+        raise ValueError(f"unexpected wireguard dump output: ‘{output.strip()}’")
+    try:
+        now = int(lines[0])
+        interface = lines[1].split("\t")
+        peers: Dict[str, WgPeerStatus] = {}
+        for line in lines[2:]:
+            fields = line.split("\t")
+            peers[fields[0]] = WgPeerStatus(
+                public_key=fields[0],
+                endpoint=None if fields[2] == "(none)" else fields[2],
+                allowed_ips=[] if fields[3] == "(none)" else fields[3].split(","),
+                latest_handshake=int(fields[4]),
+                transfer_rx=int(fields[5]),
+                transfer_tx=int(fields[6]),
+            )
+        return WgInterfaceDump(
+            now=now,
+            public_key=interface[1],
+            listen_port=int(interface[2]),
+            peers=peers,
+        )
+    except (IndexError, ValueError):
+        raise ValueError(f"unexpected wireguard dump output: ‘{output.strip()}’")
+
+
+def link_status(
+    source: str,
+    target: str,
+    target_public: Optional[str],
+    dump: WgInterfaceDump,
+    max_age: int,
+) -> WgLinkStatus:
+
+    peer = dump.peers.get(target_public) if target_public else None
+    if peer is None:
+        return WgLinkStatus(source, target, LINK_NO_PEER, None, None, None, None)
+    if peer.latest_handshake == 0:
+        status = LINK_NO_HANDSHAKE
+        age = None
+    else:
+        age = max(0, dump.now - peer.latest_handshake)
+        status = LINK_OK if age <= max_age else LINK_STALE
+    return WgLinkStatus(
+        source,
+        target,
+        status,
+        age,
+        peer.transfer_rx,
+        peer.transfer_tx,
+        None,
+        peer.endpoint,
+    )
+
+
+def endpoint_path(
+    endpoint: Optional[str], target: Optional[MachineState]
+) -> Optional[str]:
+
+    # Whether the current endpoint of a peer is the private or the public
+    # address of its machine
+    if endpoint is None or target is None:
+        return None
+    host = endpoint.rsplit(":", 1)[0]
+    if target.private_ipv4 and host == target.private_ipv4:
+        return PATH_PRIVATE
+    if target.public_ipv4 and host == target.public_ipv4:
+        return PATH_PUBLIC
+    return PATH_OTHER
+
+
+def fetch_wg_dump(m: MachineState, interface_name: str) -> WgInterfaceDump:
+    output = remote.run_command(m, probe_command(interface_name), capture_stdout=True)
+    return parse_wg_dump(output)
+
+
+def probe_deployment(
+    d: Deployment, max_age: int = DEFAULT_MAX_AGE
+) -> List[WgLinkStatus]:
+
+    # Collect the interface dumps of all machines with links concurrently,
+    # then check every declared link against the dump of its source machine
+    graph = wg_link_graph(d)
+    wg_keypairs = wg_keypair_index(d)
+    active_machines = d.active_machines
+
+    snapshots = {}
+    for name in active_machines:
+        if f"{name}-wg" in wg_keypairs and graph.links_of(name):
+            snapshots[name] = wg_keypairs[f"{name}-wg"].snapshot()
+
+    probed = {
+        name: wg_keypair for name, wg_keypair in snapshots.items() if wg_keypair.is_up
+    }
+    (dumps, failures) = run_parallel(
+        {
+            name: functools.partial(
+                fetch_wg_dump, active_machines[name], wg_keypair.interface_name
+            )
+            for name, wg_keypair in probed.items()
+        }
+    )
+
+    links: List[WgLinkStatus] = []
+    for source in sorted(snapshots):
+        for target in graph.links_of(source):
+            if source in failures or source not in dumps:
+                error = (
+                    str(failures[source])
+                    if source in failures
+                    else "wireguard keypair is not up"
+                )
+                links.append(
+                    WgLinkStatus(
+                        source, target, LINK_UNREACHABLE, None, None, None, error
+                    )
+                )
+                continue
+            target_keypair = snapshots.get(target)
+            status = link_status(
+                source,
+                target,
+                target_keypair.public if target_keypair else None,
+                dumps[source],
+                max_age,
+            )
+            links.append(
+                status._replace(
+                    path=endpoint_path(status.endpoint, active_machines.get(target))
+                )
+            )
+    return links
+
+
+def format_links(links: List[WgLinkStatus]) -> str:
+
+    rows: List[Tuple[str, ...]] = [
+        ("SOURCE", "TARGET", "STATUS", "PATH", "HANDSHAKE", "RX", "TX")
+    ]
+    for link in links:
+        rows.append(
+            (
+                link.source,
+                link.target,
+                link.status,
+                link.path or "-",
+                "-" if link.handshake_age is None else f"{link.handshake_age}s ago",
+                "-" if link.transfer_rx is None else str(link.transfer_rx),
+                "-" if link.transfer_tx is None else str(link.transfer_tx),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(col.ljust(width) for col, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def op_wg_links_probe(args: Any) -> None:
+    from nixops.script_defs import network_state, open_deployment
+
+    setup_logging()
+    with network_state(args) as sf:
+        depl = open_deployment(sf, args)
+        depl.evaluate_active()
+        try:
+            links = probe_deployment(depl, args.max_age)
+        finally:
+            remote.close_transport(depl)
+
+    flagged = [link for link in links if link.status != LINK_OK]
+    if args.json:
+        print(json.dumps([link._asdict() for link in links], indent=2))
+    else:
+        print(format_links(links))
+        errors = {link.source: link.error for link in flagged if link.error}
+        for source, error in errors.items():
+            sys.stderr.write(f"{source}: {error}\n")
+        sys.stderr.write(
+            f"{len(links) - len(flagged)} of {len(links)} wireguard link(s) are healthy\n"
+        )
+    if flagged:
+        sys.exit(1)
+
+
+def add_parser(subparsers: argparse._SubParsersAction) -> None:
+    from nixops.script_defs import add_subparser
+
+    subparser = add_subparser(
+        subparsers,
+        "wg-links-probe",
+        help="check the wireguard links of the deployment for recent handshakes",
+    )
+    subparser.set_defaults(op=op_wg_links_probe)
+    subparser.add_argument(
+        "--max-age",
+        type=int,
+        default=DEFAULT_MAX_AGE,
+        metavar="SECONDS",
+        help="flag links without a handshake in this many seconds (default: %(default)s)",
+    )
+    subparser.add_argument(
+        "--json", action="store_true", help="print the link matrix as JSON"
+    )
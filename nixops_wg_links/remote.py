@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Remote commands run by the plugin on the machines of a deployment.
+#
+# Every remote command of the plugin goes through the transport of its
+# deployment, which is kept for the duration of a deploy and closed once
+# the physical spec has been generated.  The default transport runs commands
+# through MachineState.run_command, which nixops multiplexes over a single
+# ssh control master connection per machine, so each machine costs one ssh
+# handshake per nixops invocation however many commands are run on it.
+#
+# Another transport, such as one replaying recorded outputs, can be put in
+# place with set_transport().
+
+from nixops.deployment import Deployment
+from nixops.backends import MachineState
+from typing import Any
+import abc
+import logging
+import threading
+import weakref
+
+from . import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class Transport(abc.ABC):
+    """Runs commands on the machines of a deployment."""
+
+    @abc.abstractmethod
+    def run_command(self, m: MachineState, command: str, **kwargs: Any) -> Any:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MachineTransport(Transport):
+    """Transport over the ssh connections nixops keeps to each machine."""
+
+    def run_command(self, m: MachineState, command: str, **kwargs: Any) -> Any:
+        # The connections themselves belong to nixops, which shuts them down
+        # on exit
+        return m.run_command(command, **kwargs)
+
+
+_transports: "weakref.WeakKeyDictionary[Deployment, Transport]" = weakref.WeakKeyDictionary()
+_transports_lock = threading.Lock()
+
+
+def transport(d: Deployment) -> Transport:
+    with _transports_lock:
+        if d not in _transports:
+            _transports[d] = MachineTransport()
+        return _transports[d]
+
+
+def set_transport(d: Deployment, t: Transport) -> None:
+    close_transport(d)
+    with _transports_lock:
+        _transports[d] = t
+
+
+def close_transport(d: Deployment) -> None:
+    with _transports_lock:
+        t = _transports.pop(d, None)
+    if t is not None:
+        t.close()
+
+
+def run_command(m: MachineState, command: str, **kwargs: Any) -> Any:
+
+    # Run a command on m through the transport of its deployment, counted
+    # and timed in the current instrumentation report
+    with instrumentation.remote_command():
+        return transport(m.depl).run_command(m, command, **kwargs)
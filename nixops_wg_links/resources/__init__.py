@@ -1,2 +1,3 @@
-__all__ = "wg_keypair"
+__all__ = ["wg_keypair", "wg_topology"]
 from . import wg_keypair  # noqa: F401
+from . import wg_topology  # noqa: F401
@@ -5,10 +5,44 @@
 import nixops.util
 import nixops.resources
 import logging
-from typing import Mapping, Optional, Sequence
+from nixops_wg_links import setup_logging
+from typing import Any, Dict, Mapping, Optional, Sequence
 
 logger = logging.getLogger(__name__)
 
+# State attributes captured by WgKeypairState.snapshot(), named as on the state object
+_SNAPSHOT_ATTRS = (
+    "state",
+    "kp_name",
+    "enable",
+    "dns",
+    "mtu",
+    "addr",
+    "private",
+    "public",
+    "listen_port",
+    "keepalive",
+    "use_psk",
+    "psk",
+    "sync_state",
+    "interface_name",
+    "table",
+    "pre_up",
+    "pre_down",
+    "post_up",
+    "post_down",
+    "base_ipv4",
+    "ipv4_cidr",
+    "add_no_wg_hosts",
+    "hot_reload",
+    "link_psk",
+    "link_psk_digest",
+    "endpoint_address",
+    "pending_upload",
+    "spec_fingerprint",
+    "spec",
+)
+
 
 class WgKeypairOptions(nixops.resources.ResourceOptions):
     """Definition of wireguard keypair options."""
@@ -28,7 +62,11 @@ class WgKeypairOptions(nixops.resources.ResourceOptions):
     postUp: str
     postDown: str
     baseIpv4: Mapping[str, int]
+    ipv4Cidr: Optional[str]
     addNoWgHosts: bool
+    hotReload: bool
+    linkPresharedKeys: bool
+    endpointAddress: str
 
 
 class WgKeypairDefinition(nixops.resources.ResourceDefinition):
@@ -61,7 +99,76 @@ class WgKeypairDefinition(nixops.resources.ResourceDefinition):
         self.post_up: str = self.config.postUp
         self.post_down: str = self.config.postDown
         self.base_ipv4: Mapping[str, int] = self.config.baseIpv4
+        self.ipv4_cidr: Optional[str] = self.config.ipv4Cidr
         self.add_no_wg_hosts: bool = self.config.addNoWgHosts
+        self.hot_reload: bool = self.config.hotReload
+        self.link_psk: bool = self.config.linkPresharedKeys
+        self.endpoint_address: str = self.config.endpointAddress
+
+
+class WgKeypairSnapshot:
+    """Read-only in-memory copy of a wireguard keypair resource state."""
+
+    __slots__ = ("name",) + _SNAPSHOT_ATTRS
+
+    name: str
+    state: int
+    kp_name: str
+    enable: bool
+    dns: Sequence[str]
+    mtu: Optional[int]
+    addr: str
+    private: str
+    public: str
+    listen_port: int
+    keepalive: Optional[int]
+    use_psk: bool
+    psk: str
+    sync_state: bool
+    interface_name: str
+    table: Optional[str]
+    pre_up: str
+    pre_down: str
+    post_up: str
+    post_down: str
+    base_ipv4: Mapping[str, int]
+    ipv4_cidr: Optional[str]
+    add_no_wg_hosts: bool
+    hot_reload: bool
+    link_psk: bool
+    link_psk_digest: Optional[str]
+    endpoint_address: str
+    pending_upload: bool
+    spec_fingerprint: Optional[str]
+    spec: Optional[Dict[str, Any]]
+
+    def __init__(self, **attrs: Any):
+        for attr in self.__slots__:
+            object.__setattr__(self, attr, attrs[attr])
+
+    def __setattr__(self, attr: str, value: Any) -> None:
+        raise AttributeError(f"wireguard keypair snapshot ‘{self.name}’ is read-only")
+
+    @property
+    def is_up(self) -> bool:
+        return self.state == WgKeypairState.UP
+
+    def replace(self, **attrs: Any) -> "WgKeypairSnapshot":
+        values = {attr: getattr(self, attr) for attr in self.__slots__}
+        values.update(attrs)
+        return WgKeypairSnapshot(**values)
+
+
+class _SnapshotAttrs:
+    """Stand-in for a resource state that serves attribute reads from memory."""
+
+    def __init__(self, attrs: Dict[str, str]):
+        self._attrs = attrs
+
+    def _get_attr(self, name: str, default: Any = nixops.util.undefined) -> Any:
+        # Like ResourceState._get_attr, a missing attribute reads as undefined
+        # whatever the default, attr_property substituting its own default
+        return self._attrs.get(name, nixops.util.undefined)
 
 
 class WgKeypairState(nixops.resources.ResourceState[WgKeypairDefinition]):
@@ -92,9 +199,34 @@ class WgKeypairState(nixops.resources.ResourceState[WgKeypairDefinition]):
     base_ipv4: Mapping[str, int] = nixops.util.attr_property(
         "wgKeypair.baseIpv4", {}, "json"
     )
+    ipv4_cidr: Optional[str] = nixops.util.attr_property(
+        "wgKeypair.ipv4Cidr", None, str
+    )
     add_no_wg_hosts: bool = nixops.util.attr_property(
         "wgKeypair.addNoWgHosts", True, bool
     )
+    hot_reload: bool = nixops.util.attr_property("wgKeypair.hotReload", False, bool)
+    link_psk: bool = nixops.util.attr_property(
+        "wgKeypair.linkPresharedKeys", False, bool
+    )
+    endpoint_address: str = nixops.util.attr_property(
+        "wgKeypair.endpointAddress", "public", str
+    )
+    # Digest of the per link preshared keys last uploaded to the machine
+    link_psk_digest: Optional[str] = nixops.util.attr_property(
+        "wgKeypair.linkPskDigest", None, str
+    )
+    # Whether keys were generated on creation but not uploaded to the machine yet
+    pending_upload: bool = nixops.util.attr_property(
+        "wgKeypair.pendingUpload", False, bool
+    )
+    # Wireguard configuration last deployed to the machine and a digest of its inputs
+    spec_fingerprint: Optional[str] = nixops.util.attr_property(
+        "wgKeypair.specFingerprint", None, str
+    )
+    spec: Optional[Dict[str, Any]] = nixops.util.attr_property(
+        "wgKeypair.spec", None, "json"
+    )
 
     @classmethod
     def get_type(cls) -> str:
@@ -110,6 +242,22 @@ class WgKeypairState(nixops.resources.ResourceState[WgKeypairDefinition]):
     def get_definition_prefix(self) -> str:
         return "resources.wgKeypair."
 
+    def snapshot(self) -> WgKeypairSnapshot:
+        # Fetch every state attribute of this resource in a single query and
+        # convert each one with its attr_property getter, so values match
+        # what individual property reads would return.
+        with self.depl._db:
+            c = self.depl._db.cursor()
+            c.execute(
+                "select name, value from ResourceAttrs where machine = ?", (self.id,)
+            )
+            attrs = _SnapshotAttrs(dict(c.fetchall()))
+        cls = type(self)
+        return WgKeypairSnapshot(
+            name=self.name,
+            **{attr: getattr(cls, attr).fget(attrs) for attr in _SNAPSHOT_ATTRS},
+        )
+
     def create(
         self,
         defn: WgKeypairDefinition,
@@ -117,6 +265,7 @@ class WgKeypairState(nixops.resources.ResourceState[WgKeypairDefinition]):
         allow_reboot: bool,
         allow_recreate: bool,
     ) -> None:
+        setup_logging()
         self.kp_name = f"nixops-{self.depl.uuid}-{defn.name}"
         self.enable = defn.enable
         self.dns = defn.dns
@@ -132,7 +281,16 @@ class WgKeypairState(nixops.resources.ResourceState[WgKeypairDefinition]):
         self.post_up = defn.post_up
         self.post_down = defn.post_down
         self.base_ipv4 = defn.base_ipv4
+        self.ipv4_cidr = defn.ipv4_cidr
         self.add_no_wg_hosts = defn.add_no_wg_hosts
+        self.hot_reload = defn.hot_reload
+        self.link_psk = defn.link_psk
+        self.endpoint_address = defn.endpoint_address
+
+        # lib imports this module, so it can only be imported once in use
+        from nixops_wg_links.lib import create_wg_keypair_state
+
+        create_wg_keypair_state(self)
 
         self.state = self.UP
 
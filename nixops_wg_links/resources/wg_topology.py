@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Declarative wireguard link topologies over a set of machines.
+
+import nixops.util
+import nixops.resources
+import logging
+from nixops_wg_links import setup_logging
+from typing import Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class WgTopologyOptions(nixops.resources.ResourceOptions):
+    """Definition of wireguard topology options."""
+
+    topology: str
+    machines: Sequence[str]
+    hub: Optional[str]
+    k: int
+    relay: bool
+
+
+class WgTopologyDefinition(nixops.resources.ResourceDefinition):
+    """Definition of a wireguard topology resource."""
+
+    config: WgTopologyOptions
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "wg-topology"
+
+    @classmethod
+    def get_resource_type(cls) -> str:
+        return "wgTopology"
+
+    def __init__(self, name: str, config: nixops.resources.ResourceEval):
+        super().__init__(name, config)
+        self.topology: str = self.config.topology
+        self.machines: Sequence[str] = self.config.machines
+        self.hub: Optional[str] = self.config.hub
+        self.k: int = self.config.k
+        self.relay: bool = self.config.relay
+
+
+class WgTopologyState(nixops.resources.ResourceState[WgTopologyDefinition]):
+    """State of a wireguard topology resource."""
+
+    topology: str = nixops.util.attr_property("wgTopology.topology", None, str)
+    machines: Sequence[str] = nixops.util.attr_property(
+        "wgTopology.machines", [], "json"
+    )
+    hub: Optional[str] = nixops.util.attr_property("wgTopology.hub", None, str)
+    k: int = nixops.util.attr_property("wgTopology.k", 1, int)
+    relay: bool = nixops.util.attr_property("wgTopology.relay", False, bool)
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "wg-topology"
+
+    def __init__(self, depl: nixops.deployment.Deployment, name: str, id):
+        nixops.resources.ResourceState.__init__(self, depl, name, id)
+
+    @property
+    def resource_id(self) -> str:
+        return self.name
+
+    def get_definition_prefix(self) -> str:
+        return "resources.wgTopology."
+
+    def create(
+        self,
+        defn: WgTopologyDefinition,
+        check: bool,
+        allow_reboot: bool,
+        allow_recreate: bool,
+    ) -> None:
+        setup_logging()
+        # The links are expanded from the definition when the physical spec is
+        # generated; the state only records what was last deployed
+        with self.depl._db:
+            self.topology = defn.topology
+            self.machines = defn.machines
+            self.hub = defn.hub
+            self.k = defn.k
+            self.relay = defn.relay
+            self.state = self.UP
+
+    def destroy(self, wipe: bool = False) -> bool:
+        self.log(f"destroying {self.name}...")
+        return True
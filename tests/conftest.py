@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Deployments for the tests, holding their state in an in-memory database,
+# with the remote commands of the plugin answered by a recording transport.
+
+from nixops.backends import MachineState
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+import nixops.util
+import pytest
+import sqlite3
+import threading
+import types
+
+from nixops_wg_links import remote
+from nixops_wg_links.resources.wg_keypair import WgKeypairState
+
+# Tables of the nixops state file used by the plugin
+SCHEMA = """
+create table DeploymentAttrs (
+    name text not null,
+    value text not null,
+    primary key(name)
+);
+create table ResourceAttrs (
+    machine integer not null,
+    name text not null,
+    value text not null,
+    primary key(machine, name)
+);
+"""
+
+BASE_IPV4 = {"a": 10, "b": 0, "c": 0, "d": 1}
+
+
+class StubConnection(sqlite3.Connection):
+    """State database connection serialising transactions between threads."""
+
+    # Like nixops.statefile.Connection: plugin hooks and workers share the
+    # connection, and nested transactions only commit at the outermost one
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+        self.nesting = 0
+
+    def __enter__(self) -> "StubConnection":
+        self.lock.acquire()
+        self.nesting += 1
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        try:
+            self.nesting -= 1
+            if self.nesting == 0:
+                super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.lock.release()
+
+
+class StubDeployment:
+    """Deployment with its state in memory and its definitions given directly."""
+
+    def __init__(self):
+        self.uuid = "00000000-0000-0000-0000-000000000000"
+        self.logger = mock.MagicMock()
+        self._db = sqlite3.connect(
+            ":memory:", check_same_thread=False, factory=StubConnection
+        )
+        self._db.executescript(SCHEMA)
+        self.resources: Dict[str, Any] = {}
+        self.definitions: Dict[str, Any] = {}
+        self._next_id = 1
+
+    @property
+    def active_resources(self) -> Dict[str, Any]:
+        return self.resources
+
+    @property
+    def active_machines(self) -> Dict[str, MachineState]:
+        return {
+            name: r for name, r in self.resources.items() if isinstance(r, MachineState)
+        }
+
+    def _get_attr(self, name: str, default: Any = nixops.util.undefined) -> Any:
+        # Like Deployment._get_attr, a missing attribute reads as undefined
+        with self._db:
+            c = self._db.cursor()
+            c.execute("select value from DeploymentAttrs where name = ?", (name,))
+            row = c.fetchone()
+            return row[0] if row is not None else nixops.util.undefined
+
+    def _set_attr(self, name: str, value: Any) -> None:
+        with self._db:
+            self._db.execute(
+                "insert or replace into DeploymentAttrs(name, value) values (?, ?)",
+                (name, value),
+            )
+
+    def add_resource(self, cls: Any, name: str) -> Any:
+        r = cls(self, name, self._next_id)
+        self._next_id += 1
+        self.resources[name] = r
+        return r
+
+
+class StubMachine(MachineState):
+    """Machine of a stub deployment."""
+
+    @classmethod
+    def get_type(cls) -> str:
+        return "stub"
+
+
+class RecordingTransport(remote.Transport):
+    """Transport recording the commands run, answered by a respond function."""
+
+    def __init__(self, respond: Optional[Callable[[str, str], Any]] = None):
+        self.commands: List[Tuple[str, str]] = []
+        self.respond = respond
+
+    def run_command(self, m: MachineState, command: str, **kwargs: Any) -> Any:
+        self.commands.append((m.name, command))
+        if self.respond is not None:
+            return self.respond(m.name, command)
+        return "" if kwargs.get("capture_stdout") else 0
+
+    def commands_of(self, name: str) -> List[str]:
+        return [command for (machine, command) in self.commands if machine == name]
+
+
+def add_machine(
+    d: StubDeployment,
+    name: str,
+    index: int,
+    links: List[str],
+    keys: bool = True,
+    cls: Any = StubMachine,
+    **wg_keypair_attrs: Any,
+) -> Tuple[StubMachine, WgKeypairState]:
+
+    # A machine linked to the given machines, along with its keypair
+    m = d.add_resource(cls, name)
+    m.state = m.UP
+    m.index = index
+    m.public_ipv4 = f"192.0.2.{index + 1}"
+    m.private_ipv4 = f"172.16.0.{index + 1}"
+    m.defn = types.SimpleNamespace(name=name, resource_eval={"wgLinksTo": links})
+    d.definitions[name] = m.defn
+
+    wg_keypair = d.add_resource(WgKeypairState, f"{name}-wg")
+    wg_keypair.state = wg_keypair.UP
+    wg_keypair.kp_name = f"nixops-{d.uuid}-{name}-wg"
+    wg_keypair.enable = True
+    wg_keypair.listen_port = 51820
+    wg_keypair.interface_name = "wg0"
+    wg_keypair.base_ipv4 = BASE_IPV4
+    if keys:
+        wg_keypair.private = f"private-{name}"
+        wg_keypair.public = f"public-{name}"
+        wg_keypair.psk = "psk"
+    for attr, value in wg_keypair_attrs.items():
+        setattr(wg_keypair, attr, value)
+    return (m, wg_keypair)
+
+
+def mesh(n: int, **wg_keypair_attrs: Any) -> StubDeployment:
+
+    # A deployment of n machines each linked to every other one
+    d = StubDeployment()
+    names = [f"m{i}" for i in range(n)]
+    for i, name in enumerate(names):
+        add_machine(
+            d, name, i, [other for other in names if other != name], **wg_keypair_attrs
+        )
+    return d
+
+
+@pytest.fixture
+def transport() -> Iterator[Callable[..., RecordingTransport]]:
+
+    # Put a recording transport in place on a deployment for the test
+    deployments: List[StubDeployment] = []
+
+    def install(
+        d: StubDeployment, respond: Optional[Callable[[str, str], Any]] = None
+    ) -> RecordingTransport:
+        t = RecordingTransport(respond)
+        remote.set_transport(d, t)
+        deployments.append(d)
+        return t
+
+    yield install
+    for d in deployments:
+        remote.close_transport(d)
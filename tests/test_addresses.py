@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from nixops_wg_links.lib import NowgAddressTable, WgAddressTable
+
+from conftest import add_machine, StubDeployment, StubMachine
+
+
+def address_table(d):
+    wg_keypairs = {
+        name: d.resources[f"{name}-wg"].snapshot() for name in d.active_machines
+    }
+    return WgAddressTable(wg_keypairs, d.active_machines)
+
+
+def test_index_addresses():
+    # Addresses are the machine index added to the base address, carrying
+    # across octets
+    d = StubDeployment()
+    add_machine(d, "m0", 0, ["m1"])
+    add_machine(d, "m1", 300, ["m0"])
+    add_machine(d, "m2", 1, [], base_ipv4={"a": 10, "b": 1, "c": 0, "d": 1})
+    addrs = address_table(d)
+
+    assert addrs["m0"] == "10.0.0.1"
+    assert addrs["m1"] == "10.0.1.45"
+    assert addrs["m2"] == "10.1.0.2"
+    assert addrs.prefixlen("m0") == 24
+    assert addrs.collisions == []
+
+
+def test_index_collisions_and_missing_index():
+    d = StubDeployment()
+    add_machine(d, "m0", 1, ["m1"])
+    add_machine(d, "m1", 0, ["m0"], base_ipv4={"a": 10, "b": 0, "c": 0, "d": 2})
+    m2, _ = add_machine(d, "m2", 2, [])
+    m2.index = None
+    addrs = address_table(d)
+
+    assert addrs.collisions == [["m0", "m1"]]
+    assert not addrs.has_index("m2")
+    with pytest.raises(ValueError):
+        addrs["m2"]
+
+
+def test_cidr_addresses_are_kept():
+    d = StubDeployment()
+    add_machine(d, "m0", 0, ["m1"], ipv4_cidr="10.10.0.0/29", addr="10.10.0.5")
+    add_machine(d, "m1", 1, ["m0"], ipv4_cidr="10.10.0.0/29")
+    add_machine(d, "m2", 2, ["m0"], ipv4_cidr="10.10.0.0/29", addr="10.10.0.9")
+    addrs = address_table(d)
+
+    assert addrs["m0"] == "10.10.0.5"
+    assert addrs["m1"] == "10.10.0.1"
+    assert addrs["m2"] == "10.10.0.2"
+    assert addrs.prefixlen("m0") == 29
+
+
+def test_cidr_addresses_of_keypairs_not_up_are_reserved():
+    # A keypair which is not up gets its address back once up again
+    d = StubDeployment()
+    _, wg_keypair = add_machine(
+        d, "m0", 0, ["m1"], ipv4_cidr="10.10.0.0/29", addr="10.10.0.1"
+    )
+    wg_keypair.state = wg_keypair.STOPPED
+    add_machine(d, "m1", 1, ["m0"], ipv4_cidr="10.10.0.0/29")
+    addrs = address_table(d)
+
+    assert "m0" not in addrs
+    assert addrs["m1"] == "10.10.0.2"
+
+    wg_keypair.state = wg_keypair.UP
+    addrs = address_table(d)
+    assert addrs["m0"] == "10.10.0.1"
+
+
+class NetworkMachine(StubMachine):
+    """Machine reaching machines of its network at their private address."""
+
+    region = "region"
+    network = "net-a"
+    resolved = 0
+
+    def address_to(self, r):
+        NetworkMachine.resolved += 1
+        if isinstance(r, NetworkMachine) and r.network == self.network:
+            return r.private_ipv4
+        return super().address_to(r)
+
+
+def test_nowg_addresses_of_backends_overriding_address_to():
+    # Machines of the same backend and region may still see different
+    # addresses, so each is resolved on its own, while machines keeping the
+    # default address_to are resolved once for all of them
+    d = StubDeployment()
+    add_machine(d, "m0", 0, [])
+    add_machine(d, "m1", 1, [])
+    add_machine(d, "m2", 2, [])
+    for (index, network) in [(3, "net-a"), (4, "net-a"), (5, "net-b")]:
+        n = d.add_resource(NetworkMachine, f"n{index - 3}")
+        n.public_ipv4 = f"192.0.2.{index + 1}"
+        n.private_ipv4 = f"172.16.0.{index + 1}"
+        n.network = network
+    NetworkMachine.resolved = 0
+    nowg = NowgAddressTable(d.active_machines.values(), d.active_resources)
+
+    assert NetworkMachine.resolved == 3 * len(d.active_resources)
+    assert nowg.address("n0", "n1") == "172.16.0.5"
+    assert nowg.address("n1", "n0") == "172.16.0.4"
+    assert nowg.address("n2", "n0") == "192.0.2.4"
+    assert nowg.address("n0", "n2") == "192.0.2.6"
+    assert nowg.address("m0", "n0") == "192.0.2.4"
+    assert nowg.address("m1", "m0") == "192.0.2.1"
+    assert nowg.addresses("m0") is nowg.addresses("m1")
+    assert nowg.hosts("n0")["172.16.0.5"] == ["n1-nowg"]
+    assert "172.16.0.5" not in nowg.hosts("n2")
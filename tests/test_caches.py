@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from nixops_wg_links import lib
+from nixops_wg_links.lib import wg_keypair_index, wg_link_graph
+
+from conftest import add_machine, mesh
+
+
+def test_caches_follow_resources():
+    d = mesh(2)
+    assert sorted(wg_keypair_index(d)) == ["m0-wg", "m1-wg"]
+    assert wg_keypair_index(d) is wg_keypair_index(d)
+
+    add_machine(d, "m2", 2, ["m0"])
+    assert sorted(wg_keypair_index(d)) == ["m0-wg", "m1-wg", "m2-wg"]
+
+
+def test_caches_follow_definitions():
+    # Re-evaluated definitions of the same size replace the link graph
+    d = mesh(2)
+    assert wg_link_graph(d).links_of("m0") == ("m1",)
+    graph = wg_link_graph(d)
+    assert wg_link_graph(d) is graph
+
+    # The old definitions are freed first, so the new ones are likely to be
+    # allocated at the same address
+    definitions = dict(d.definitions)
+    d.definitions = None
+    d.definitions = definitions.copy()
+    d.definitions["m0"].resource_eval = {"wgLinksTo": []}
+    d.definitions["m1"].resource_eval = {"wgLinksTo": []}
+    assert wg_link_graph(d) is not graph
+    assert wg_link_graph(d).links_of("m0") == ()
+
+
+def deployed_mesh(n):
+
+    # A mesh whose machines were all deployed with the specs of a matrix,
+    # without nowg hosts so that addresses only reach specs through keypairs
+    d = mesh(n, add_no_wg_hosts=False)
+    for name in d.active_machines:
+        lib.record_wg_deploying(d, name)
+    lib.mk_matrix(d)
+    return d
+
+
+def fingerprints(d):
+    return {
+        name: d.resources[f"{name}-wg"].spec_fingerprint for name in d.active_machines
+    }
+
+
+def state_writes(d, fn):
+    statements = []
+    d._db.set_trace_callback(statements.append)
+    try:
+        fn()
+    finally:
+        d._db.set_trace_callback(None)
+    return [s for s in statements if s.split()[0].lower() in ("insert", "delete")]
+
+
+def test_unchanged_specs_are_reused():
+    d = deployed_mesh(3)
+    before = fingerprints(d)
+    specs = {name: d.resources[f"{name}-wg"].spec for name in d.active_machines}
+
+    assert state_writes(d, lambda: lib.mk_matrix(d)) == []
+    assert fingerprints(d) == before
+    assert lib.wg_matrix(d, dry_run=True).specs == specs
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda d: setattr(d.resources["m1-wg"], "public", "public-m1-new"),
+        lambda d: setattr(d.resources["m1-wg"], "listen_port", 51821),
+        lambda d: setattr(d.resources["m1"], "public_ipv4", "192.0.2.100"),
+    ],
+    ids=["key", "port", "ip"],
+)
+def test_peer_changes_invalidate_specs(change):
+    d = deployed_mesh(3)
+    before = fingerprints(d)
+
+    change(d)
+    attrs = lib.mk_matrix(d)
+    after = fingerprints(d)
+    # Every machine linked to the changed one is regenerated
+    assert after["m0"] != before["m0"]
+    assert after["m2"] != before["m2"]
+    (config,) = attrs["m0"]
+    peers = config[("networking", "wg-quick", "interfaces", "wg0", "peers")]
+    keypair = d.resources["m1-wg"]
+    assert {
+        "publicKey": keypair.public,
+        "endpoint": f"{d.resources['m1'].public_ipv4}:{keypair.listen_port}",
+    }.items() <= peers[0].items()
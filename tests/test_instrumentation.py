@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from nixops_wg_links import instrumentation, lib
+
+from conftest import mesh
+
+
+def read_reports(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_trace_callbacks_are_kept(tmp_path, monkeypatch):
+    # Statements keep being passed to callbacks added before instrumenting
+    monkeypatch.setenv("NIXOPS_WG_LINKS_REPORT", str(tmp_path / "report.json"))
+    d = mesh(1)
+    statements = []
+    instrumentation.add_trace_callback(d._db, statements.append)
+    try:
+        with instrumentation.instrument("test", d) as report:
+            d.resources["m0-wg"].public
+            assert report.counters["db_reads"] == 1
+            assert len(statements) == 1
+        d.resources["m0-wg"].public
+        assert len(statements) == 2
+    finally:
+        instrumentation.remove_trace_callback(d._db, statements.append)
+
+    d.resources["m0-wg"].public
+    assert len(statements) == 2
+    assert report.counters["db_reads"] == 1
+
+
+def test_state_writer_writes_are_counted(tmp_path, monkeypatch):
+    # Writes made by the state writer thread are counted in the report of
+    # the hook which submitted them
+    path = tmp_path / "report.json"
+    monkeypatch.setenv("NIXOPS_WG_LINKS_REPORT", str(path))
+    d = mesh(1)
+    wg_keypair = d.resources["m0-wg"]
+    with instrumentation.instrument("test", d):
+        with instrumentation.phase("save"):
+            lib.save_wg_keypair_attrs(wg_keypair, {"mtu": 1420, "hot_reload": True})
+
+    [report] = read_reports(path)
+    assert report["counters"]["db_writes"] == 2
+    assert report["phases"]["save"]["db_writes"] == 2
+    assert wg_keypair.mtu == 1420
+
+
+def test_profile(tmp_path, monkeypatch):
+    prefix = tmp_path / "profile"
+    monkeypatch.setenv("NIXOPS_WG_LINKS_PROFILE", str(prefix))
+    with instrumentation.instrument("test", mesh(1), "m0"):
+        pass
+
+    assert (tmp_path / "profile.test.m0.prof").exists()
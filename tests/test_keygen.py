@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import os
+import pytest
+
+from nixops_wg_links import keygen, lib
+
+from conftest import add_machine, mesh
+
+
+@pytest.fixture
+def wg_tool(tmp_path, monkeypatch):
+
+    # A wg tool generating predictable keys, used in place of the in-process
+    # key generation
+    wg = tmp_path / "wg"
+    wg.write_text(
+        "#!/bin/sh\n"
+        + 'case "$1" in\n'
+        + "  genkey) echo private ;;\n"
+        + '  pubkey) read key; echo "public-$key" ;;\n'
+        + "  genpsk) echo generated-psk ;;\n"
+        + "esac\n"
+    )
+    os.chmod(wg, 0o755)
+    monkeypatch.setattr(keygen, "in_process_backend", lambda: None)
+    return str(wg)
+
+
+def test_generate_wg_keypairs_share_a_psk():
+    if keygen.in_process_backend() is None:
+        pytest.skip("cryptography or PyNaCl is required")
+    keys = keygen.generate_wg_keypairs(3)
+
+    assert len({private for (private, _, _) in keys}) == 3
+    assert len({psk for (_, _, psk) in keys}) == 1
+    assert len(base64.b64decode(keys[0][2])) == 32
+    assert {psk for (_, _, psk) in keygen.generate_wg_keypairs(2, psk="psk")} == {"psk"}
+
+
+def test_generate_wg_keypairs_with_wg(wg_tool):
+    assert keygen.generate_wg_keypairs(2, wg_tool) == [
+        ("private", "public-private", "generated-psk"),
+        ("private", "public-private", "generated-psk"),
+    ]
+    assert keygen.generate_wg_keypairs(1, wg_tool, psk="psk") == [
+        ("private", "public-private", "psk")
+    ]
+
+
+def test_pregenerated_keypairs_get_the_consensus_psk():
+    d = mesh(3)
+    d.resources["m2-wg"].psk = "other"
+    add_machine(d, "m3", 3, ["m0"], keys=False)
+    add_machine(d, "m4", 4, ["m0"], keys=False)
+    # Per link preshared keys have no part in the consensus
+    add_machine(d, "m5", 5, ["m0"], link_psk=True, psk="other")
+    add_machine(d, "m6", 6, ["m0"], link_psk=True, psk="other")
+
+    assert lib.wg_consensus_psk(d) == "psk"
+    assert lib.pregenerate_wg_keypairs(d) == 2
+    assert lib.take_wg_keypair(d, "m3-wg")[2] == "psk"
+    assert lib.take_wg_keypair(d, "m4-wg")[2] == "psk"
+
+
+def test_key_queries_only_read_the_deployment_keypairs():
+    d = mesh(2)
+    # Keypairs of another deployment of the same state file
+    with d._db:
+        for id in (100, 101, 102):
+            d._db.executemany(
+                "insert into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                [
+                    (id, "wgKeypair.public", f"public-{id}"),
+                    (id, "wgKeypair.presharedKey", "foreign"),
+                ],
+            )
+    statements = []
+    d._db.set_trace_callback(statements.append)
+
+    assert lib.wg_consensus_psk(d) == "psk"
+    assert lib.wg_public_keys(d, ["m0", "m1", "m2"]) == {
+        "m0": "public-m0",
+        "m1": "public-m1",
+    }
+    ids = ", ".join(str(d.resources[f"{name}-wg"].id) for name in ("m0", "m1"))
+    selects = [s for s in statements if s.startswith("select")]
+    assert len(selects) == 2
+    assert all(f"where machine in ({ids})" in s for s in selects)
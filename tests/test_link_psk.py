@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+from nixops_wg_links import lib
+
+from conftest import mesh
+
+
+def test_link_psk_secret_is_kept():
+    d = mesh(2)
+    secret = lib.link_psk_secret(d)
+
+    assert len(secret) == 32
+    assert base64.b64decode(d._get_attr(lib.LINK_PSK_SECRET_ATTR)) == secret
+    assert lib.link_psk_secret(d) == secret
+
+
+def test_derive_link_psk_is_symmetric():
+    secret = lib.link_psk_secret(mesh(2))
+    psk = lib.derive_link_psk(secret, "public-m0", "public-m1")
+
+    assert psk == lib.derive_link_psk(secret, "public-m1", "public-m0")
+    assert psk != lib.derive_link_psk(secret, "public-m0", "public-m2")
+    assert len(base64.b64decode(psk)) == 32
+
+
+def test_sync_link_psks(transport):
+    d = mesh(3, link_psk=True)
+    t = transport(d)
+    m0 = d.resources["m0"]
+    wg_keypair = d.resources["m0-wg"]
+    lib.sync_link_psks(m0, wg_keypair)
+
+    [command] = t.commands_of("m0")
+    secret = lib.link_psk_secret(d)
+    for peer in ("m1", "m2"):
+        psk = lib.derive_link_psk(secret, "public-m0", f"public-{peer}")
+        assert f'echo "{psk}" > {peer}.new' in command
+    assert wg_keypair.link_psk_digest is not None
+
+    # Keys are only uploaded again once they change, or when forced
+    lib.sync_link_psks(m0, wg_keypair)
+    assert len(t.commands_of("m0")) == 1
+    lib.sync_link_psks(m0, wg_keypair, force=True)
+    assert len(t.commands_of("m0")) == 2
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from nixops_wg_links import lib
+
+from conftest import add_machine, mesh, StubDeployment, StubMachine
+
+
+def peers_of(attrs, name, interface="wg0"):
+    (config,) = attrs[name]
+    return config[("networking", "wg-quick", "interfaces", interface, "peers")]
+
+
+def endpoints_of(attrs, name):
+    return {peer["publicKey"]: peer["endpoint"] for peer in peers_of(attrs, name)}
+
+
+class LanMachine(StubMachine):
+    """Machine reaching the other machines of its backend at their private address."""
+
+    def address_to(self, r):
+        if isinstance(r, LanMachine):
+            return r.private_ipv4
+        return super().address_to(r)
+
+
+def test_public_endpoints():
+    attrs = lib.mk_matrix(mesh(3))
+
+    assert endpoints_of(attrs, "m0") == {
+        "public-m1": "192.0.2.2:51820",
+        "public-m2": "192.0.2.3:51820",
+    }
+
+
+def test_private_endpoints():
+    d = mesh(3)
+    d.resources["m0-wg"].endpoint_address = "private"
+    attrs = lib.mk_matrix(d)
+
+    assert endpoints_of(attrs, "m0") == {
+        "public-m1": "172.16.0.2:51820",
+        "public-m2": "172.16.0.3:51820",
+    }
+    # Only the machines selecting private endpoints use them
+    assert endpoints_of(attrs, "m1")["public-m0"] == "192.0.2.1:51820"
+
+
+def test_auto_endpoints():
+    # Machines reach their peers at the address resolved by their backend,
+    # falling back to the public address
+    d = StubDeployment()
+    names = ["m0", "m1", "m2"]
+    for i, (name, cls) in enumerate(zip(names, [LanMachine, LanMachine, StubMachine])):
+        links = [other for other in names if other != name]
+        add_machine(d, name, i, links, cls=cls, endpoint_address="auto")
+    attrs = lib.mk_matrix(d)
+
+    assert endpoints_of(attrs, "m0") == {
+        "public-m1": "172.16.0.2:51820",
+        "public-m2": "192.0.2.3:51820",
+    }
+    assert endpoints_of(attrs, "m2") == {
+        "public-m0": "192.0.2.1:51820",
+        "public-m1": "192.0.2.2:51820",
+    }
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from nixops_wg_links import lib
+from nixops_wg_links.plan import (
+    CHANGE_ADDED,
+    CHANGE_CHANGED,
+    plan_deployment,
+    WgConfigChange,
+)
+
+from conftest import add_machine, mesh
+
+
+def deploy(d, names):
+
+    # Generate the physical spec after the post_wait hooks of the given
+    # machines ran, as a deploy including them would
+    for name in names:
+        lib.record_wg_deploying(d, name)
+    lib.mk_matrix(d)
+
+
+def test_plan_of_a_deployed_mesh():
+    d = mesh(3)
+    deploy(d, ["m0", "m1", "m2"])
+    assert plan_deployment(d) == ([], [])
+
+    # Only the machine whose own configuration changed is to be included
+    d.resources["m1-wg"].mtu = 1400
+    (changes, include) = plan_deployment(d)
+    assert changes == [
+        WgConfigChange("m1", "interface.mtu", CHANGE_CHANGED, None, 1400)
+    ]
+    assert include == ["m1"]
+
+    # A peer change reaches every machine linked to it
+    d.resources["m2-wg"].listen_port = 51821
+    (changes, include) = plan_deployment(d)
+    assert [(c.machine, c.path) for c in changes] == [
+        ("m0", "peers.m2"),
+        ("m1", "interface.mtu"),
+        ("m1", "peers.m2"),
+        ("m2", "interface.listenPort"),
+    ]
+    assert include == ["m0", "m1", "m2"]
+
+
+def test_plan_is_not_recorded():
+    d = mesh(2, add_no_wg_hosts=False)
+    deploy(d, ["m0", "m1"])
+    add_machine(d, "m2", 2, [], add_no_wg_hosts=False)
+
+    (changes, include) = plan_deployment(d)
+    assert changes == [WgConfigChange("m2", "spec", CHANGE_ADDED, None, None)]
+    assert plan_deployment(d) == (changes, include)
+    assert d.resources["m2-wg"].spec is None
+
+
+def test_only_machines_in_the_deploy_are_recorded():
+    # Without post_wait hooks, such as for a dry run or a build only deploy,
+    # nothing is recorded as deployed
+    d = mesh(3)
+    lib.mk_matrix(d)
+    assert plan_deployment(d)[1] == ["m0", "m1", "m2"]
+
+    # With --include, only the included machines are
+    deploy(d, ["m1"])
+    (changes, include) = plan_deployment(d)
+    assert include == ["m0", "m2"]
+    assert {change.path for change in changes} == {"spec"}
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import contextlib
+import json
+import nixops.script_defs
+import pytest
+
+from nixops_wg_links import probe
+
+from conftest import mesh
+
+NOW = 1600000000
+
+
+def wg_dump(name, peers):
+
+    # Output of the probe command on a machine, given for each peer its
+    # endpoint and the time of its latest handshake
+    lines = [str(NOW), f"private-{name}\tpublic-{name}\t51820\toff"]
+    for peer, (endpoint, handshake) in sorted(peers.items()):
+        lines.append(
+            f"public-{peer}\tpsk\t{endpoint}\t10.0.0.0/32\t{handshake}\t100\t200\t25"
+        )
+    return "\n".join(lines) + "\n"
+
+
+DUMPS = {
+    "m0": wg_dump("m0", {"m1": ("172.16.0.2:51820", NOW - 5), "m2": ("(none)", 0)}),
+    "m1": wg_dump(
+        "m1", {"m0": ("192.0.2.1:51820", NOW - 500), "m2": ("198.51.100.7:51820", NOW)}
+    ),
+}
+
+
+def respond(name, command):
+    assert command == probe.probe_command("wg0")
+    if name not in DUMPS:
+        raise Exception("ssh: connect to host: Connection refused")
+    return DUMPS[name]
+
+
+def test_parse_wg_dump():
+    dump = probe.parse_wg_dump(DUMPS["m0"])
+    assert dump.now == NOW
+    assert dump.public_key == "public-m0"
+    assert dump.listen_port == 51820
+    assert dump.peers["public-m1"].endpoint == "172.16.0.2:51820"
+    assert dump.peers["public-m1"].allowed_ips == ["10.0.0.0/32"]
+    assert dump.peers["public-m2"].endpoint is None
+    with pytest.raises(ValueError):
+        probe.parse_wg_dump("1600000000\n")
+
+
+def test_probe_deployment(transport):
+    d = mesh(3)
+    t = transport(d, respond)
+    links = {(link.source, link.target): link for link in probe.probe_deployment(d)}
+
+    assert sorted(name for (name, _) in t.commands) == ["m0", "m1", "m2"]
+    assert links[("m0", "m1")].status == probe.LINK_OK
+    assert links[("m0", "m1")].handshake_age == 5
+    assert links[("m0", "m1")].path == probe.PATH_PRIVATE
+    assert links[("m0", "m2")].status == probe.LINK_NO_HANDSHAKE
+    assert links[("m0", "m2")].path is None
+    assert links[("m1", "m0")].status == probe.LINK_STALE
+    assert links[("m1", "m0")].path == probe.PATH_PUBLIC
+    assert links[("m1", "m2")].path == probe.PATH_OTHER
+    assert links[("m2", "m0")].status == probe.LINK_UNREACHABLE
+    assert "Connection refused" in links[("m2", "m0")].error
+
+
+def test_op_wg_links_probe(transport, monkeypatch, capsys):
+    # Link definitions are only known once the deployment is evaluated
+    d = mesh(2)
+    transport(d, respond)
+    definitions = d.definitions
+    d.definitions = None
+    d.evaluate_active = lambda: setattr(d, "definitions", definitions)
+
+    monkeypatch.setattr(
+        nixops.script_defs, "network_state", lambda args: contextlib.nullcontext()
+    )
+    monkeypatch.setattr(nixops.script_defs, "open_deployment", lambda sf, args: d)
+    with pytest.raises(SystemExit) as e:
+        probe.op_wg_links_probe(argparse.Namespace(max_age=180, json=True))
+
+    assert e.value.code == 1
+    links = json.loads(capsys.readouterr().out)
+    assert [(link["source"], link["target"], link["status"]) for link in links] == [
+        ("m0", "m1", probe.LINK_OK),
+        ("m1", "m0", probe.LINK_STALE),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from nixops_wg_links import remote
+
+from conftest import mesh, RecordingTransport, StubMachine
+
+
+class CommandMachine(StubMachine):
+    """Machine answering remote commands with their length."""
+
+    def run_command(self, command, **kwargs):
+        return len(command)
+
+
+class ClosingTransport(RecordingTransport):
+    """Recording transport noting whether it was closed."""
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        remote.Transport()
+
+
+def test_machine_transport():
+    d = mesh(0)
+    m = d.add_resource(CommandMachine, "m0")
+    assert isinstance(remote.transport(d), remote.MachineTransport)
+    assert remote.run_command(m, "true", check=False) == 4
+    remote.close_transport(d)
+
+
+def test_set_transport():
+    d = mesh(2)
+    first = ClosingTransport()
+    remote.set_transport(d, first)
+    assert remote.run_command(d.resources["m0"], "true", check=False) == 0
+    assert first.commands == [("m0", "true")]
+
+    # A transport put in place closes the previous one
+    second = ClosingTransport()
+    remote.set_transport(d, second)
+    assert first.closed
+    assert remote.transport(d) is second
+    remote.close_transport(d)
+    assert second.closed
+    assert isinstance(remote.transport(d), remote.MachineTransport)
+    remote.close_transport(d)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from nixops_wg_links import lib
+from nixops_wg_links.resources.wg_topology import WgTopologyDefinition
+
+from conftest import add_machine, StubDeployment
+
+
+def add_topology(d, name, topology, machines, hub=None, k=1, relay=False):
+
+    # An evaluated wgTopology definition, without a nix evaluation
+    defn = WgTopologyDefinition.__new__(WgTopologyDefinition)
+    defn.name = name
+    defn.topology = topology
+    defn.machines = machines
+    defn.hub = hub
+    defn.k = k
+    defn.relay = relay
+    d.definitions[name] = defn
+
+
+def deployment(names):
+    d = StubDeployment()
+    for i, name in enumerate(names):
+        add_machine(d, name, i, [])
+    return d
+
+
+def matrix_problems(d):
+    with pytest.raises(ValueError) as e:
+        lib.mk_matrix(d)
+    return str(e.value)
+
+
+def test_topology_links():
+    d = deployment(["m0", "m1", "m2", "m3"])
+    add_topology(d, "ring", "ring", ["m0", "m1", "m2", "m3"])
+    add_topology(d, "star", "star", ["m0", "m1", "m2"], hub="m0", relay=True)
+    graph = lib.wg_link_graph(d)
+
+    assert graph.problems == []
+    assert graph.links_of("m0") == ("m3", "m1", "m2")
+    assert graph.links_of("m2") == ("m1", "m3", "m0")
+    assert graph.relay_hub("m1") == "m0"
+    assert graph.relays == frozenset(["m0"])
+
+
+def test_topology_problems_are_collected():
+    d = deployment(["m0", "m1", "m2"])
+    add_topology(d, "bad-hub", "star", ["m0", "m1"], hub="m2")
+    add_topology(d, "bad-relay", "mesh", ["m0", "m2"], relay=True)
+    graph = lib.wg_link_graph(d)
+
+    # Topologies with problems have no links, and do not stop the graph
+    # from being built
+    assert graph.links_of("m0") == ()
+    assert graph.relays == frozenset()
+    problems = matrix_problems(d)
+    assert "2 problem(s)" in problems
+    assert "wireguard star topology ‘bad-hub’ requires a hub" in problems
+    assert "wireguard topology ‘bad-relay’ can only relay" in problems
+
+
+def test_unknown_machines_are_reported_by_source():
+    d = deployment(["m0", "m1"])
+    d.definitions["m0"].resource_eval = {"wgLinksTo": ["m1", "ghost"]}
+    d.definitions["m1"].resource_eval = {"wgLinksTo": ["m0"]}
+    add_topology(d, "mesh", "mesh", ["m0", "m1", "phantom"])
+    problems = matrix_problems(d)
+
+    assert "2 problem(s)" in problems
+    assert (
+        "‘deployment.wgLinksTo’ in machine ‘m0’ refers to an unknown machine ‘ghost’"
+        in problems
+    )
+    assert (
+        "wireguard topology ‘mesh’ refers to an unknown machine ‘phantom’" in problems
+    )
+
+
+def test_relay_through_the_hub():
+    d = deployment(["m0", "m1", "m2", "m3", "m4"])
+    add_topology(d, "star", "star", ["m0", "m1", "m2", "m3"], hub="m0", relay=True)
+    attrs = lib.mk_matrix(d)
+
+    def config_of(name):
+        (config,) = attrs[name]
+        return config
+
+    def peers_of(name):
+        return config_of(name)[("networking", "wg-quick", "interfaces", "wg0", "peers")]
+
+    # Spokes have the hub as their single peer, routing the whole wireguard
+    # network through it
+    for spoke in ("m1", "m2", "m3"):
+        assert [(p["publicKey"], p["allowedIPs"]) for p in peers_of(spoke)] == [
+            ("public-m0", ["10.0.0.0/24"])
+        ]
+    # and reach the other spokes by name through it
+    assert config_of("m1")[("networking", "hosts")] == {
+        "127.0.0.1": ["m1"],
+        "10.0.0.1": ["m0-wg"],
+        "10.0.0.2": ["m1-wg"],
+        "10.0.0.3": ["m2-wg"],
+        "10.0.0.4": ["m3-wg"],
+        "192.0.2.1": ["m0-nowg"],
+        "192.0.2.2": ["m1-nowg"],
+        "192.0.2.3": ["m2-nowg"],
+        "192.0.2.4": ["m3-nowg"],
+        "192.0.2.5": ["m4-nowg"],
+    }
+
+    # The hub forwards between the spokes, each of which it has a peer for
+    sysctl = ("boot", "kernel", "sysctl", "net.ipv4.ip_forward")
+    assert config_of("m0")[sysctl] == 1
+    assert sysctl not in config_of("m1")
+    assert [(p["publicKey"], p["allowedIPs"]) for p in peers_of("m0")] == [
+        ("public-m1", ["10.0.0.2/32"]),
+        ("public-m2", ["10.0.0.3/32"]),
+        ("public-m3", ["10.0.0.4/32"]),
+    ]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import pytest
+import subprocess
+
+from nixops_wg_links import lib
+
+from conftest import mesh
+
+
+def peer(name, allowed_ips, psk_file="/etc/nixops-wg-links/wireguard.psk"):
+    return {
+        "publicKey": f"public-{name}",
+        "presharedKeyFile": psk_file,
+        "endpoint": f"{name}.example.com:51820",
+        "persistentKeepalive": None,
+        "allowedIPs": allowed_ips,
+    }
+
+
+def test_upload_wg_keypair_command():
+    d = mesh(2)
+    wg_keypair = d.resources["m0-wg"]
+    command = lib.upload_wg_keypair_command(wg_keypair, "private", "public", "psk")
+
+    assert 'echo "private" > /etc/nixops-wg-links/wireguard.private' in command
+    assert 'echo "psk" > /etc/nixops-wg-links/wireguard.psk' in command
+    assert "systemctl stop wg-quick-wg0.service || exit 2" in command
+    assert "sha256sum" not in command
+
+    command = lib.upload_wg_keypair_command(
+        wg_keypair, "private", "public", "psk", only_if_changed=True
+    )
+    digest = lib.wg_key_file_digest("private")
+    assert command.startswith("if printf")
+    assert f"{digest}  /etc/nixops-wg-links/wireguard.private" in command
+    assert f"exit {lib.WG_KEYS_IN_SYNC}" in command
+
+
+def test_upload_wg_keypair_command_hot_reload():
+    d = mesh(2, hot_reload=True)
+    wg_keypair = d.resources["m0-wg"]
+    command = lib.upload_wg_keypair_command(wg_keypair, "private", "public", "psk")
+
+    assert "wg set wg0 private-key /etc/nixops-wg-links/wireguard.private" in command
+    assert "preshared-key /etc/nixops-wg-links/wireguard.psk" in command
+    assert "systemctl stop" not in command
+
+    # Per link preshared keys are set on the interface by their own upload
+    wg_keypair.link_psk = True
+    command = lib.upload_wg_keypair_command(wg_keypair, "private", "public", "psk")
+    assert "preshared-key" not in command
+
+
+@pytest.mark.parametrize(
+    "status, only_if_changed, hot_reload, outcome",
+    [
+        (0, False, False, True),
+        (0, True, False, True),
+        (lib.WG_KEYS_IN_SYNC, True, False, False),
+        (lib.WG_KEYS_IN_SYNC, False, False, "unable to save wireguard keys"),
+        (2, False, True, "unable to set wireguard keys on interface wg0"),
+        (2, False, False, "unable to stop wg-quick-wg0.service"),
+        (1, False, False, "unable to save wireguard keys"),
+    ],
+)
+def test_upload_wg_keypair_status(
+    transport, status, only_if_changed, hot_reload, outcome
+):
+    d = mesh(2, hot_reload=hot_reload)
+    t = transport(d, lambda name, command: status)
+    upload = (
+        d.resources["m0"],
+        d.resources["m0-wg"],
+        "private",
+        "public",
+        "psk",
+        only_if_changed,
+    )
+
+    if isinstance(outcome, str):
+        with pytest.raises(Exception, match=outcome):
+            lib.upload_wg_keypair(*upload)
+    else:
+        assert lib.upload_wg_keypair(*upload) is outcome
+    assert len(t.commands_of("m0")) == 1
+
+
+def test_sync_state_skips_keys_in_sync(transport, caplog):
+    d = mesh(2, sync_state=True)
+    t = transport(d, lambda name, command: lib.WG_KEYS_IN_SYNC)
+    lib.generate_wg_keypair(d.resources["m0"])
+
+    [command] = t.commands_of("m0")
+    assert lib.wg_key_file_digest("private-m0") in command
+    with caplog.at_level(logging.INFO, logger="nixops_wg_links.lib"):
+        lib.report_wg_keys_synced(d)
+    assert "already in sync on 1 of 1 machine(s)" in caplog.text
+
+
+def test_generate_wg_keypair_uploads_new_keys(transport):
+    d = mesh(2)
+    wg_keypair = d.resources["m0-wg"]
+    wg_keypair.private = None
+    t = transport(d)
+    lib.generate_wg_keypair(d.resources["m0"])
+
+    [command] = t.commands_of("m0")
+    assert f'echo "{wg_keypair.private}"' in command
+    assert wg_keypair.psk == "psk"
+
+
+def test_wg_peers_script(tmp_path):
+    # Run the script against wg and ip commands logging their arguments,
+    # with one peer on the interface which is no longer wanted
+    log = tmp_path / "log"
+    for tool, output in (("wg", "public-m1\npublic-gone"), ("ip", "")):
+        path = tmp_path / tool
+        path.write_text(
+            "#!/bin/sh\n"
+            + f'echo "{tool} $*" >> {log}\n'
+            + f'[ "$1" = show ] && printf "%s\\n" "{output}"\n'
+            + "true\n"
+        )
+        os.chmod(path, 0o755)
+    script = lib.wg_peers_script(
+        "wg0", None, [peer("m1", ["10.0.0.2/32"]), peer("m2", ["10.0.0.3/32"])]
+    )
+    subprocess.run(
+        ["sh", "-e", "-c", script],
+        check=True,
+        env={"PATH": f"{tmp_path}:{os.environ['PATH']}"},
+    )
+
+    lines = log.read_text().splitlines()
+    assert lines == [
+        "wg set wg0 peer public-m1 preshared-key /etc/nixops-wg-links/wireguard.psk "
+        + "endpoint m1.example.com:51820 persistent-keepalive off allowed-ips 10.0.0.2/32",
+        "ip route replace 10.0.0.2/32 dev wg0",
+        "wg set wg0 peer public-m2 preshared-key /etc/nixops-wg-links/wireguard.psk "
+        + "endpoint m2.example.com:51820 persistent-keepalive off allowed-ips 10.0.0.3/32",
+        "ip route replace 10.0.0.3/32 dev wg0",
+        "wg show wg0 peers",
+        "wg set wg0 peer public-gone remove",
+    ]
+
+
+def test_wg_peers_script_without_routes():
+    script = lib.wg_peers_script("wg0", "off", [peer("m1", ["10.0.0.2/32"], None)])
+
+    assert "ip route" not in script
+    assert "preshared-key /dev/null" in script
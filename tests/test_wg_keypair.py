@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from nixops_wg_links import lib
+from nixops_wg_links.resources.wg_keypair import _SNAPSHOT_ATTRS, WgKeypairState
+
+from conftest import add_machine, mesh, StubDeployment
+
+
+@pytest.fixture
+def keys(monkeypatch):
+
+    # Predictable keys in place of the generated ones
+    def generate_wg_keypairs(count, wg_path=None, psk=None):
+        return [(f"private-{i}", f"public-{i}", psk or "new-psk") for i in range(count)]
+
+    monkeypatch.setattr(lib, "generate_wg_keypairs", generate_wg_keypairs)
+
+
+def test_snapshot_defaults():
+    # Attributes never written read back their attr_property defaults
+    d = StubDeployment()
+    wg_keypair = d.add_resource(WgKeypairState, "m0-wg")
+    snapshot = wg_keypair.snapshot()
+
+    assert snapshot.dns == []
+    assert snapshot.base_ipv4 == {}
+    assert snapshot.use_psk is True
+    assert snapshot.add_no_wg_hosts is True
+    assert snapshot.endpoint_address == "public"
+    assert snapshot.spec is None
+    for attr in _SNAPSHOT_ATTRS:
+        assert getattr(snapshot, attr) == getattr(wg_keypair, attr)
+
+
+def test_snapshot_values():
+    # Written attributes are converted by their attr_property getter
+    d = StubDeployment()
+    wg_keypair = d.add_resource(WgKeypairState, "m0-wg")
+    wg_keypair.dns = ["10.0.0.1"]
+    wg_keypair.base_ipv4 = {"a": 10, "b": 1, "c": 0, "d": 1}
+    wg_keypair.mtu = 1420
+    wg_keypair.use_psk = False
+    wg_keypair.hot_reload = True
+    wg_keypair.spec = {"peers": ["m1"]}
+    snapshot = wg_keypair.snapshot()
+
+    assert snapshot.dns == ["10.0.0.1"]
+    assert snapshot.base_ipv4 == {"a": 10, "b": 1, "c": 0, "d": 1}
+    assert snapshot.mtu == 1420
+    assert snapshot.use_psk is False
+    assert snapshot.hot_reload is True
+    assert snapshot.spec == {"peers": ["m1"]}
+    for attr in _SNAPSHOT_ATTRS:
+        assert getattr(snapshot, attr) == getattr(wg_keypair, attr)
+
+
+def test_keys_generated_at_creation_are_uploaded_by_post_wait(keys, transport):
+    d = StubDeployment()
+    (m0, wg_keypair0) = add_machine(d, "m0", 0, ["m1"], keys=False)
+    (_, wg_keypair1) = add_machine(d, "m1", 1, ["m0"], keys=False)
+    (_, wg_keypair2) = add_machine(d, "m2", 2, [], keys=False)
+    t = transport(d)
+
+    # Keys are generated in state when the keypairs are created, for linked
+    # machines only, and left for post_wait to upload
+    for wg_keypair in (wg_keypair0, wg_keypair1, wg_keypair2):
+        lib.create_wg_keypair_state(wg_keypair)
+    assert t.commands == []
+    assert (wg_keypair0.private, wg_keypair0.public, wg_keypair0.psk) == (
+        "private-0",
+        "public-0",
+        "new-psk",
+    )
+    assert (wg_keypair1.private, wg_keypair1.public) == ("private-1", "public-1")
+    assert wg_keypair0.pending_upload and wg_keypair1.pending_upload
+    assert wg_keypair2.private is None and not wg_keypair2.pending_upload
+
+    lib.generate_wg_keypair(m0)
+    (command,) = t.commands_of("m0")
+    assert 'echo "private-0" > /etc/nixops-wg-links/wireguard.private' in command
+    assert 'echo "new-psk" > /etc/nixops-wg-links/wireguard.psk' in command
+    assert wg_keypair0.private == "private-0"
+    assert not wg_keypair0.pending_upload
+    assert wg_keypair1.pending_upload
+    assert t.commands_of("m1") == []
+
+
+def test_psk_resync_clears_pending_upload(transport):
+    d = mesh(3)
+    d.resources["m2-wg"].psk = "other"
+    d.resources["m2-wg"].pending_upload = True
+    t = transport(d)
+    lib.mk_matrix(d)
+
+    # The upload of the consensus preshared key also uploads the keys
+    (command,) = t.commands_of("m2")
+    assert 'echo "private-m2" > /etc/nixops-wg-links/wireguard.private' in command
+    assert 'echo "psk" > /etc/nixops-wg-links/wireguard.psk' in command
+    assert d.resources["m2-wg"].psk == "psk"
+    assert not d.resources["m2-wg"].pending_upload
+    assert t.commands_of("m0") == t.commands_of("m1") == []